@@ -0,0 +1,60 @@
+"""
+Micro-benchmarks of the parsing hot paths, to check that an optimisation actually pays off.
+
+    python benchmark.py -n 100000
+"""
+from __future__ import print_function
+
+import argparse
+import random
+import time
+import timeit
+from datetime import datetime
+
+import parser as gcparser
+
+
+def timestamps(count):
+    """
+    count timestamps in the format Garmin Connect uses in TCX files, one second apart like trackpoints
+    """
+    start = random.randint(1262304000, 1577836800)
+    return [datetime.utcfromtimestamp(start + i).strftime('%Y-%m-%dT%H:%M:%S.000Z') for i in range(count)]
+
+
+def strptime_mktime(values):
+    """
+    The conversion GCFileParser used before isoToEpoch (which also took the UTC times as local time)
+    """
+    return [int(time.mktime(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.000Z').timetuple())) for value in values]
+
+
+def iso_to_epoch(values):
+    return [gcparser.isoToEpoch(value) for value in values]
+
+
+def best_of(call, repeat):
+    return min(timeit.repeat(call, number=1, repeat=repeat))
+
+
+def run_timestamps(count, repeat):
+    values = timestamps(count)
+    baseline = best_of(lambda: strptime_mktime(values), repeat)
+    print('{} timestamps, best of {}:'.format(count, repeat))
+    print('  {:<28} {:8.4f}s'.format('strptime + mktime', baseline))
+    for name, call in [('isoToEpoch', lambda: iso_to_epoch(values)),
+                       ('isoToEpochArray', lambda: gcparser.isoToEpochArray(values))]:
+        seconds = best_of(call, repeat)
+        print('  {:<28} {:8.4f}s  {:6.1f}x'.format(name, seconds, baseline / seconds))
+
+
+def run_benchmark():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the TCX parsing hot paths')
+    parser.add_argument('-n', '--count', type=int, default=100000, help='Number of timestamps to convert')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs to take the best of')
+    args = vars(parser.parse_args())
+    run_timestamps(args['count'], args['repeat'])
+
+
+if __name__ == '__main__':
+    run_benchmark()
@@ -0,0 +1,216 @@
+"""
+Columnar copy of the Wellness files, for visualisation.py: instead of thousands of small JSON files, the heart rate,
+stress and step series of all days are kept as a few typed NumPy arrays that are memory mapped when loaded.
+
+The store lives in the columnar folder inside the Wellness folder. For every series there are arrays of times
+(milliseconds since the epoch), values and, for the steps, activity levels, all days one after the other, plus
+offsets marking where each day starts. index.json lists the days with a hash of their files (see
+storage.stamps_digest) and holds the small per-day data: the wellness metrics and the sleep times. ingest only
+parses the files of days that changed since it last ran.
+
+    python columnar.py -i ~/garmin/username/Wellness
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+
+import storage
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+COLUMNAR = 'columnar'
+INDEX = 'index.json'
+
+# Series -> its arrays besides the offsets
+SERIES = {'heartrate': ['time', 'value'],
+          'stress': ['time', 'value'],
+          'steps': ['time', 'value', 'level']}
+
+# Activity levels of the periods of the daily summary, as numbered in the level arrays; -1 is unknown
+ACTIVITY_LEVELS = {'sleeping': 0, 'sedentary': 1, 'active': 2, 'highlyActive': 3,
+                   'generic': 4, 'none': 4, 'unmonitored': 4}
+
+DTYPES = {'time': 'int64', 'value': 'float32', 'level': 'int8', 'offsets': 'int64'}
+
+
+def available():
+    """
+    Whether NumPy, which the columnar store needs, is installed
+    """
+    return np is not None
+
+
+class WellnessColumns(object):
+    """
+    The columnar store of a Wellness folder, see load
+    """
+
+    def __init__(self, index, arrays):
+        self.index = index
+        self.arrays = arrays
+        self.days = index['days']
+        self.positions = dict((date, i) for i, date in enumerate(self.days))
+
+    def __contains__(self, date):
+        return date in self.positions
+
+    def series(self, name, date):
+        """
+        Dict of field -> array of series name on date ('time' in milliseconds since the epoch, 'value' with NaN
+        where Garmin had no value), or None when date is not in the store
+        """
+        i = self.positions.get(date)
+        if i is None:
+            return None
+        offsets = self.arrays[name]['offsets']
+        start, end = offsets[i], offsets[i + 1]
+        return dict((field, self.arrays[name][field][start:end]) for field in SERIES[name])
+
+    def metrics(self, date):
+        """
+        metricsMap of the wellness file of date, as in that file
+        """
+        return self.index['metrics'].get(date)
+
+    def sleep(self, date):
+        """
+        [start, end] of the sleep of date in milliseconds since the epoch, or None
+        """
+        return self.index['sleep'].get(date)
+
+
+def array_path(folder, name, field, generation):
+    return os.path.join(folder, '{}.{}.{}.npy'.format(name, field, generation))
+
+
+def load(directory):
+    """
+    The columnar store of the Wellness folder directory, memory mapped, or None when there is none yet
+    """
+    if np is None:
+        raise ImportError('The columnar wellness store needs numpy')
+    folder = os.path.join(directory, COLUMNAR)
+    if not os.path.exists(os.path.join(folder, INDEX)):
+        return None
+    with open(os.path.join(folder, INDEX), 'r') as f:
+        index = json.load(f)
+    arrays = {}
+    for name, fields in SERIES.items():
+        arrays[name] = dict((field, np.load(array_path(folder, name, field, index['generation']), mmap_mode='r'))
+                            for field in fields + ['offsets'])
+    return WellnessColumns(index, arrays)
+
+
+def read_day(store, date, names):
+    """
+    Parse the files of date into {series: {field: array}}, its metricsMap and its sleep times
+    """
+    def read(kind):
+        name = '{}_{}.json'.format(date, kind)
+        if name not in names:
+            return None
+        return json.loads(store.read(name).decode('utf-8'))
+
+    day = {}
+    pairs = {'heartrate': (read('heartrate') or {}).get('heartRateValues') or [],
+             'stress': (read('stress') or {}).get('stressValuesArray') or []}
+    for name, values in pairs.items():
+        day[name] = {'time': np.array([value[0] for value in values], dtype=DTYPES['time']),
+                     'value': np.array([np.nan if value[1] is None else value[1] for value in values],
+                                       dtype=DTYPES['value'])}
+    summary = read('summary') or []
+    day['steps'] = {'time': np.array([item['startGMT'][:19] for item in summary], dtype='datetime64[ms]')
+                              .astype(DTYPES['time']),
+                    'value': np.array([item['steps'] for item in summary], dtype=DTYPES['value']),
+                    'level': np.array([ACTIVITY_LEVELS.get(item['primaryActivityLevel'], -1) for item in summary],
+                                      dtype=DTYPES['level'])}
+
+    wellness = read('wellness')
+    try:
+        metrics = wellness['allMetrics']['metricsMap']
+    except (TypeError, KeyError):
+        metrics = None
+    sleep = ((read('sleep') or {}).get('dailySleepDTO') or {})
+    times = [sleep.get('sleepStartTimestampGMT'), sleep.get('sleepEndTimestampGMT')]
+    return day, metrics, times if times[1] else None
+
+
+def ingest(directory, dates=None):
+    """
+    Bring the columnar store of the Wellness folder directory up to date with its files, parsing only the days
+    that changed, and return it (see load). With dates, only those days are brought up to date; the other
+    days in the store stay as they are.
+    """
+    store = storage.open_store(directory)
+    days = storage.names_by_day(store)
+    old = load(directory)
+    stamps = dict(old.index['stamps']) if old is not None and dates is not None else {}
+    for date in (days if dates is None else dates):
+        if date in days:
+            stamps[date] = storage.stamps_digest(store, days[date])
+        else:
+            stamps.pop(date, None)
+    if old is not None and old.index['stamps'] == stamps:
+        return old
+    dates = sorted(stamps)
+
+    index = {'generation': old.index['generation'] + 1 if old is not None else 1,
+             'days': dates, 'stamps': stamps, 'metrics': {}, 'sleep': {}}
+    parts = dict((name, dict((field, []) for field in fields)) for name, fields in SERIES.items())
+    lengths = dict((name, []) for name in SERIES)
+    for date in dates:
+        if old is not None and old.index['stamps'].get(date) == stamps[date]:
+            day = dict((name, old.series(name, date)) for name in SERIES)
+            metrics, sleep = old.metrics(date), old.sleep(date)
+        else:
+            day, metrics, sleep = read_day(store, date, days[date])
+        for name, fields in SERIES.items():
+            for field in fields:
+                parts[name][field].append(day[name][field])
+            lengths[name].append(len(day[name]['time']))
+        if metrics is not None:
+            index['metrics'][date] = metrics
+        if sleep is not None:
+            index['sleep'][date] = sleep
+
+    # Write the arrays under the new generation before the index pointing at them, so an interrupted ingest
+    # leaves the previous store intact
+    folder = os.path.join(directory, COLUMNAR)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for name, fields in SERIES.items():
+        offsets = np.zeros(len(dates) + 1, dtype=DTYPES['offsets'])
+        offsets[1:] = np.cumsum(lengths[name])
+        columns = dict((field, np.concatenate([np.zeros(0, dtype=DTYPES[field])] + parts[name][field])
+                        .astype(DTYPES[field])) for field in fields)
+        columns['offsets'] = offsets
+        for field, values in columns.items():
+            with storage.atomic_write(array_path(folder, name, field, index['generation'])) as f:
+                np.save(f, values)
+    with storage.atomic_write(os.path.join(folder, INDEX)) as f:
+        f.write(json.dumps(index).encode('utf-8'))
+    if old is not None:
+        for name, fields in SERIES.items():
+            for field in fields + ['offsets']:
+                os.remove(array_path(folder, name, field, old.index['generation']))
+    return load(directory)
+
+
+def run_ingest():
+    parser = argparse.ArgumentParser(description='Convert the Wellness files to the columnar store visualisation.py '
+                                                 'reads')
+    parser.add_argument('-i', '--input', required=True, help='Wellness folder')
+    args = vars(parser.parse_args())
+    columns = ingest(args['input'])
+    print('{} days, {} heart rate, {} stress and {} step values'.format(
+        len(columns.days), len(columns.arrays['heartrate']['time']), len(columns.arrays['stress']['time']),
+        len(columns.arrays['steps']['time'])))
+
+
+if __name__ == '__main__':
+    run_ingest()
@@ -18,28 +18,46 @@ The following updates work for me using Python 2.7 and Mechanize
 """
 
 import argparse
+import csv
+import hashlib
 import json
 import logging
 import os
+import random
 import re
-import shutil
 import sys
+import threading
+import time
+import zlib
 from datetime import datetime, timedelta
+from email.utils import mktime_tz, parsedate_tz
 from getpass import getpass
 try:
     # Python 3
-    from urllib.parse import urlencode
+    import queue
+    from urllib.parse import urlencode, urlparse
 except ImportError:
     # Python 2
+    import Queue as queue
     from urllib import urlencode
+    from urlparse import urlparse
 
 import mechanize as me
 
+import storage
+import summaries
+try:
+    # Optional, gives pooled keep-alive connections
+    import requests
+except ImportError:
+    requests = None
+
 BASE_URL = "https://sso.garmin.com/sso/login"
 GAUTH = "https://connect.garmin.com/modern/auth/hostname"
 SSO = "https://sso.garmin.com/sso"
 CSS = "https://static.garmincdn.com/com.garmin.connect/ui/css/gauth-custom-v1.2-min.css"
 REDIRECT = "https://connect.garmin.com/modern/"
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.2 (KHTML, like Gecko) Chrome/15.0.874.121 Safari/535.2'
 
 ACTIVITIES = "https://connect.garmin.com/modern/proxy/activitylist-service/activities/search/activities?start=%s&limit=%s"
 WELLNESS = "https://connect.garmin.com/modern/proxy/userstats-service/wellness/daily/%s?fromDate=%s&untilDate=%s"
@@ -51,6 +69,31 @@ SLEEP = "https://connect.garmin.com/modern/proxy/wellness-service/wellness/daily
 TCX = "https://connect.garmin.com/modern/proxy/download-service/export/tcx/activity/%s"
 GPX = "https://connect.garmin.com/modern/proxy/download-service/export/gpx/activity/%s"
 
+# Index of downloaded activities, one JSON object per line, kept in the Historical folder
+MANIFEST = 'manifest.jsonl'
+ACTIVITY_FILE_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})_(\d+)\.txt(\.gz|\.zst)?$')
+# High-water mark of the last complete sync, kept next to the manifest
+SYNCSTATE = 'sync.json'
+# Progress of a running download, in the Historical or Wellness folder, removed again when it completes
+CHECKPOINT = 'checkpoint.json'
+
+# Download threads append to the same manifest
+MANIFEST_LOCK = threading.Lock()
+
+# Responses are read and written to disk in blocks of this many bytes
+CHUNK_SIZE = 64 * 1024
+
+# Activity types (typeId, or parentTypeId for their variants like treadmill_running or virtual_ride) of which
+# the TCX export is known to name the sport so
+TCX_SPORTS = {1: 'Running', 2: 'Biking'}
+
+# A pack is compacted after a download when this fraction of it holds records that were downloaded again
+COMPACT_GARBAGE = 0.25
+
+# Seconds between two requests to the same host when several workers download at the same time; a single worker
+# is not throttled unless --interval asks for it
+PARALLEL_INTERVAL = 0.2
+
 
 def get_logger():
     """
@@ -101,6 +144,46 @@ def get_daterange(start_date, end_date):
     return dates
 
 
+class LoginError(Exception):
+    pass
+
+
+def session_file(session_dir, username):
+    return os.path.join(session_dir, re.sub(r'[^\w.@-]', '_', username) + '.cookies')
+
+
+def save_session(agent, file_path):
+    """
+    Store the cookies of agent (in an LWPCookieJar, see login_user) in file_path, readable for the current user only
+    """
+    directory = os.path.dirname(file_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, 0o700)
+    fd = os.open(file_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write('#LWP-Cookies-2.0\n')
+        f.write(agent.cookiejar.as_lwp_str(ignore_discard=True))
+    os.rename(file_path + '.tmp', file_path)
+
+
+def load_session(agent, file_path):
+    """
+    Put the cookies saved in file_path, which have not expired yet, into the cookie jar of agent
+    """
+    jar = me.LWPCookieJar()
+    jar.load(file_path, ignore_discard=True)
+    for cookie in jar:
+        agent.cookiejar.set_cookie(cookie)
+
+
+def session_is_valid(agent):
+    try:
+        response = agent.open(ACTIVITIES % (0, 1))
+    except me.HTTPError:
+        return False
+    return not is_signin_url(response.geturl())
+
+
 def login(logger, agent, username, password):
     global BASE_URL, GAUTH, REDIRECT, SSO, CSS
 
@@ -108,7 +191,7 @@ def login(logger, agent, username, password):
     agent.set_handle_refresh(False)  # can sometimes hang without this
     script_url = 'https://sso.garmin.com/sso/signin?'
     agent.open(script_url)
-    agent.addheaders = [('User-agent', 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.2 (KHTML, like Gecko) Chrome/15.0.874.121 Safari/535.2')]
+    agent.addheaders = [('User-agent', USER_AGENT)]
     hostname_url = agent.open(GAUTH)
     hostname = json.loads(hostname_url.get_data())['host']
 
@@ -150,11 +233,11 @@ def login(logger, agent, username, password):
     # Submit the login!
     res = agent.submit()
     if res.get_data().find(b"Invalid") >= 0:
-        quit("Login failed! Check your credentials, or submit a bug report.")
+        raise LoginError("Login failed! Check your credentials, or submit a bug report.")
     elif res.get_data().find(b"SUCCESS") >= 0:
         logger.info('Login successful! Proceeding...')
     else:
-        quit('UNKNOWN STATE. This script may need to be updated. Submit a bug report.')
+        raise LoginError('UNKNOWN STATE. This script may need to be updated. Submit a bug report.')
 
     # Now we need a very specific URL from the response.
     response_url = re.search("response_url\s*=\s*\"(.*)\";", res.get_data().decode('utf-8')).groups()[0]
@@ -163,139 +246,687 @@ def login(logger, agent, username, password):
     # In theory, we're in.
 
 
-def file_exists_in_folder(filename, folder):
-    "Check if the file exists in folder of any subfolder"
-    for _, _, files in os.walk(folder):
-        if filename in files:
-            return True
-    return False
+def content_digest(f):
+    """
+    Size and SHA-1 of the contents of file object f, read in chunks
+    """
+    sha = hashlib.sha1()
+    size = 0
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        sha.update(chunk)
+        size += len(chunk)
+    return size, sha.hexdigest()
 
 
-def activities(logger, agent, username, outdir, increment = 100):
-    global ACTIVITIES
-    currentIndex = 0
-    initUrl = ACTIVITIES % (currentIndex, increment)  # 100 activities seems a nice round number
-    try:
-        response = agent.open(initUrl)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping.'.format(username))
-        return
-    search = json.loads(response.get_data().decode('utf-8'))
-    while True:
-        if len(search) == 0:
-            # All done!
-            # print('Download complete')
-            break
+def tcx_sport(activity):
+    """
+    Sport of an item of the activity list as named in the Activity element of its TCX file, so the file does
+    not need to be opened to find out; None when that is not certain, leaving it to the parser
+    """
+    activity_type = activity.get('activityType') or {}
+    for type_id in (activity_type.get('typeId'), activity_type.get('parentTypeId')):
+        if type_id in TCX_SPORTS:
+            return TCX_SPORTS[type_id]
+    return None
 
-        for item in search:
-            # Read this list of activities and save the files.
 
-            activityId = item['activityId']
-            activityDate = item['startTimeLocal'][:10]
-            url = TCX % activityId
-            file_name = '{}_{}.txt'.format(activityDate, activityId)
-            if file_exists_in_folder(file_name, outdir):
-                logger.info('{} already exists in {}. Skipping.'.format(file_name, outdir))
+def manifest_entry(file_name, activity_id, activity_date, size, sha1, sport=None):
+    """
+    Manifest line for an activity; size and sha1 are those of the (uncompressed) TCX contents, sport is
+    that of the activity list (see tcx_sport) when known
+    """
+    entry = {'activityId': str(activity_id),
+             'date': activity_date,
+             'file': file_name,
+             'size': size,
+             'sha1': sha1}
+    if sport:
+        entry['sport'] = sport
+    return entry
+
+
+def rebuild_manifest(logger, folder):
+    """
+    Recreate the manifest from the <date>_<id>.txt(.gz) files already present in folder (or any subfolder),
+    and from the records packed in folder
+    """
+    logger.info('Rebuilding activity manifest for %s', folder)
+    manifest = {}
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            match = ACTIVITY_FILE_RE.match(filename)
+            if not match:
                 continue
-            logger.info('{} is downloading...'.format(file_name))
-            datafile = agent.open(url).get_data().decode('utf-8')
-            file_path = os.path.join(outdir, file_name)
-            f = open(file_path, "w")
-            f.write(datafile)
-            f.close()
-            shutil.copy(file_path, os.path.join(os.path.dirname(os.path.dirname(file_path)), file_name))
+            with storage.open_file(os.path.join(root, filename)) as f:
+                size, sha1 = content_digest(f)
+            entry = manifest_entry(filename, match.group(2), match.group(1), size, sha1)
+            manifest[entry['activityId']] = entry
+    if storage.PackStore.present(folder):
+        pack = storage.PackStore(folder)
+        for name in pack.names():
+            match = ACTIVITY_FILE_RE.match(name)
+            if not match:
+                continue
+            size, sha1 = content_digest(pack.open(name))
+            entry = manifest_entry(name, match.group(2), match.group(1), size, sha1)
+            manifest[entry['activityId']] = entry
+
+    # Write to a temporary file first, so an interrupted rebuild never leaves a half manifest behind
+    manifest_path = os.path.join(folder, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(manifest_path + '.tmp', manifest_path)
+    return manifest
+
+
+def load_manifest(logger, folder):
+    """
+    Read the activity manifest of folder into a dict keyed by activityId, rebuilding it when missing
+    """
+    manifest_path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return rebuild_manifest(logger, folder)
+
+    manifest = {}
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line can be cut off when a run was interrupted; that activity just gets downloaded again
+                logger.warning('Ignoring damaged line in %s', manifest_path)
+                continue
+            manifest[entry['activityId']] = entry
+    return manifest
 
-        # We still have at least 1 activity.
-        currentIndex += increment
-        url = ACTIVITIES % (currentIndex, increment)
-        response = agent.open(url)
-        search = json.loads(response.get_data().decode('utf-8'))
 
+def add_to_manifest(manifest, folder, entry):
+    """
+    Append entry to the manifest. Only call this after the activity file has been completely written.
+    """
+    manifest_path = os.path.join(folder, MANIFEST)
+    with MANIFEST_LOCK:
+        cut_off = False
+        if os.path.exists(manifest_path) and os.path.getsize(manifest_path) > 0:
+            with open(manifest_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                cut_off = f.read(1) != b'\n'
+        with open(manifest_path, 'a') as f:
+            if cut_off:
+                # End the line an interrupted run left unfinished, so it does not swallow the new entry
+                f.write('\n')
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        manifest[entry['activityId']] = entry
+
+
+class RateLimiter(object):
+    """
+    Spaces requests to the same host at least `interval` seconds apart, shared by all download threads
+    """
 
-def wellness(logger, agent, username, start_date, display_name, outdir):
-    url = WELLNESS % (display_name, start_date, start_date)
-    try:
-        response = agent.open(url)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping wellness for {}.'.format(username, start_date))
-        return
-    content = response.get_data().decode('utf-8')
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
 
-    file_name = '{}_wellness.json'.format(start_date)
-    file_path = os.path.join(outdir, file_name)
-    with open(file_path, "w") as f:
-        f.write(content)
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
 
-def dailysummary(logger, agent, username, date, display_name, outdir):
-    url = DAILYSUMMARY % (display_name, date)
-    try:
-        response = agent.open(url)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping daily summary for {}.'.format(username, date))
-        return
-    content = response.get_data().decode('utf-8')
+def make_opener(agent):
+    """
+    Plain mechanize opener that shares the cookies (and thus the login session) and headers of agent. Unlike
+    Browser.open, it does not keep a seekable copy of every response in memory, so bodies can be streamed.
+    """
+    opener = me.build_opener(me.HTTPCookieProcessor(agent.cookiejar))
+    opener.addheaders = list(agent.addheaders)
+    return opener
 
-    file_name = '{}_summary.json'.format(date)
-    file_path = os.path.join(outdir, file_name)
-    with open(file_path, "w") as f:
-        f.write(content)
+
+class SessionExpired(Exception):
+    """
+    Garmin Connect answered 401 or sent us to the sign in page
+    """
+    pass
 
 
-def dailystress(logger, agent, username, date, outdir):
-    url = STRESS % (date)
+def is_signin_url(url):
+    return url.startswith(SSO)
+
+
+def copy_cookies(source, target):
+    """
+    Copy the cookies of mechanize cookie jar source into target, a mechanize or requests cookie jar
+    """
+    target.clear()
+    for cookie in source:
+        if requests is not None and isinstance(target, requests.cookies.RequestsCookieJar):
+            cookie = requests.cookies.create_cookie(cookie.name, cookie.value, domain=cookie.domain, path=cookie.path,
+                                                    secure=cookie.secure, expires=cookie.expires)
+        target.set_cookie(cookie)
+
+
+class RateLimited(Exception):
+    """
+    Garmin Connect answered 429 Too Many Requests, possibly telling us how long to wait
+    """
+
+    def __init__(self, url, retry_after=None):
+        Exception.__init__(self, 'Too many requests for {}'.format(url))
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a Retry-After header, which holds either seconds or an HTTP date
+    """
+    if not value:
+        return None
     try:
-        response = agent.open(url)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping daily stress for {}.'.format(username, date))
-        return
-    content = response.get_data().decode('utf-8')
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class Transport(object):
+    """
+    HTTP access on the session of a logged in Browser. With the requests package installed, all threads share
+    one pool of persistent connections; without it every thread gets its own mechanize opener, which opens a
+    new connection for every request.
+    Responses are asked for gzip compressed and are read in chunks, so they can be streamed to disk.
+    When the session expires halfway, relogin() is called for a freshly logged in Browser.
+    """
+
+    def __init__(self, agent, interval=0, pool_size=1, limiter=None, relogin=None, shared=None):
+        self.agent = agent
+        self.limiter = limiter or RateLimiter(interval)
+        self.relogin = relogin
+        # Login generation, shared by the transports of all threads so only one of them logs in again
+        self.shared = shared or {'lock': threading.Lock(), 'generation': 0}
+        self.session = None
+        self.opener = None
+        if requests is not None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+            self.session.headers.update(dict(agent.addheaders))
+            self.session.headers['Accept-Encoding'] = 'gzip'
+            copy_cookies(agent.cookiejar, self.session.cookies)
+        else:
+            self.opener = make_opener(agent)
+
+    def for_thread(self):
+        """
+        Transport to use from another thread
+        """
+        if self.session is not None:
+            return self
+        return Transport(self.agent, limiter=self.limiter, relogin=self.relogin, shared=self.shared)
+
+    def _refresh_session(self, generation):
+        with self.shared['lock']:
+            if self.shared['generation'] != generation:
+                # Another thread already logged in again
+                return
+            agent = self.relogin()
+            # The cookie jar object is shared with the openers of the other threads, so update it in place
+            copy_cookies(agent.cookiejar, self.agent.cookiejar)
+            if self.session is not None:
+                copy_cookies(agent.cookiejar, self.session.cookies)
+            self.shared['generation'] += 1
+
+    def _open(self, url):
+        """
+        Request url, returning a generator over the body
+        """
+        self.limiter.wait(url)
+        if self.session is not None:
+            response = self.session.get(url, stream=True)
+            if response.status_code == 401 or is_signin_url(response.url):
+                response.close()
+                raise SessionExpired(url)
+            if response.status_code == 429:
+                response.close()
+                raise RateLimited(url, parse_retry_after(response.headers.get('Retry-After')))
+            response.raise_for_status()
+            return self._iter_requests(response)
+
+        try:
+            response = self.opener.open(me.Request(url, headers={'Accept-Encoding': 'gzip'}))
+        except me.HTTPError as e:
+            if e.code == 401:
+                raise SessionExpired(url)
+            if e.code == 429:
+                raise RateLimited(url, parse_retry_after(e.info().get('Retry-After')))
+            raise
+        if is_signin_url(response.geturl()):
+            response.close()
+            raise SessionExpired(url)
+        return self._iter_mechanize(response)
+
+    def _iter_requests(self, response):
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                yield chunk
+        finally:
+            response.close()
+
+    def _iter_mechanize(self, response):
+        decompressor = None
+        if response.info().get('Content-Encoding') == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield decompressor.decompress(chunk) if decompressor else chunk
+            if decompressor:
+                yield decompressor.flush()
+        finally:
+            response.close()
+
+    def chunks(self, url):
+        """
+        Generate the (decompressed) response body of url in chunks of at most CHUNK_SIZE bytes
+        """
+        generation = self.shared['generation']
+        try:
+            body = self._open(url)
+        except SessionExpired:
+            if self.relogin is None:
+                raise
+            self._refresh_session(generation)
+            body = self._open(url)
+        for chunk in body:
+            yield chunk
+
+    def get(self, url):
+        """
+        Response body of url, as bytes
+        """
+        return b''.join(self.chunks(url))
+
+
+# Seconds to wait before the first retry of a failed request, doubled for every next attempt
+BACKOFF = 1.0
+
+
+def is_retryable(error):
+    """
+    Whether a request that failed with error may succeed when tried again: not for client errors like 404
+    """
+    if isinstance(error, SessionExpired):
+        return False
+    if isinstance(error, me.HTTPError):
+        return error.code >= 500
+    if requests is not None and isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return True
+
+
+def with_backoff(logger, call, url, retries=3):
+    """
+    Return call(url), trying again up to `retries` times with exponential backoff and jitter. After a 429
+    the Retry-After time of the server is used instead. Raises the last error.
+    """
+    attempt = 0
+    while True:
+        try:
+            return call(url)
+        except Exception as e:
+            if attempt >= retries or not (isinstance(e, RateLimited) or is_retryable(e)):
+                raise
+            if isinstance(e, RateLimited) and e.retry_after is not None:
+                delay = e.retry_after
+            else:
+                delay = BACKOFF * 2 ** attempt
+                delay += random.uniform(0, delay)
+            logger.info('Request for %s failed (%s), retrying in %.1f seconds', url, e, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def fetch_with_backoff(logger, transport, url, retries=3):
+    """
+    Get the body of url, see with_backoff
+    """
+    return with_backoff(logger, transport.get, url, retries)
+
 
-    file_name = '{}_stress.json'.format(date)
-    file_path = os.path.join(outdir, file_name)
-    with open(file_path, "w") as f:
-        f.write(content)
+class Checkpoint(object):
+    """
+    Progress of a long download, saved to a JSON file on every update so an interrupted run can resume
+    """
 
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.state = {}
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, 'r') as f:
+                    self.state = json.load(f)
+            except ValueError:
+                self.state = {}
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            with open(self.file_path + '.tmp', 'w') as f:
+                json.dump(self.state, f)
+            os.rename(self.file_path + '.tmp', self.file_path)
+
+    def clear(self):
+        with self.lock:
+            self.state = {}
+            if os.path.exists(self.file_path):
+                os.remove(self.file_path)
+
+
+def run_pool(logger, transport, jobs, worker, workers=1):
+    """
+    Call worker(transport, job) for every job, spread over `workers` threads that each use a transport on
+    the session of transport; with a single worker, jobs run in order on transport itself. Either way, a job
+    that raises is logged and the others go on. Returns the jobs that failed.
+    """
+    failed = []
 
-def dailyheartrate(logger, agent, username, date, display_name, outdir):
-    url = HEARTRATE % (display_name, date)
+    def run(job_transport, job):
+        try:
+            worker(job_transport, job)
+        except Exception:
+            logger.exception('Download of %s failed, it will be retried on the next run', job)
+            failed.append(job)
+
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            run(transport, job)
+        return failed
+
+    jobqueue = queue.Queue()
+    for job in jobs:
+        jobqueue.put(job)
+
+    def work():
+        thread_transport = transport.for_thread()
+        while True:
+            try:
+                job = jobqueue.get_nowait()
+            except queue.Empty:
+                return
+            run(thread_transport, job)
+
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(jobs)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
+
+
+def download_activity(logger, transport, store, outdir, manifest, activityId, activityDate, retries=3, sport=None):
+    """
+    Stream the TCX of an activity into store and add it to the manifest in outdir
+    """
+    url = TCX % activityId
+    file_name = '{}_{}.txt'.format(activityDate, activityId)
+    logger.info('{} is downloading...'.format(file_name))
+    digest = {}
+
+    def fetch(url):
+        sha = hashlib.sha1()
+        digest['size'] = 0
+        for chunk in transport.chunks(url):
+            sha.update(chunk)
+            digest['size'] += len(chunk)
+            yield chunk
+        digest['sha1'] = sha.hexdigest()
+
+    with_backoff(logger, lambda url: store.write_chunks(file_name, fetch(url)), url, retries)
+    add_to_manifest(manifest, outdir, manifest_entry(file_name, activityId, activityDate, digest['size'], digest['sha1'],
+                                                     sport))
+
+
+def load_sync_state(folder):
+    """
+    Read the high-water mark of the previous sync: {'activityId': .., 'startTimeLocal': ..}, and 'summaries'
+    once the whole activity list was gone through, so all activities have a summary (see activities)
+    """
+    state_path = os.path.join(folder, SYNCSTATE)
+    if not os.path.exists(state_path):
+        return {}
     try:
-        response = agent.open(url)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping daily heart rate for {}.'.format(username, date))
-        return
-    content = response.get_data().decode('utf-8')
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
 
-    file_name = '{}_heartrate.json'.format(date)
-    file_path = os.path.join(outdir, file_name)
-    with open(file_path, "w") as f:
-        f.write(content)
+def save_sync_state(folder, state):
+    state_path = os.path.join(folder, SYNCSTATE)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(state_path + '.tmp', state_path)
+
+
+def activities(logger, transport, username, outdir, increment = 100, incremental = False, since = None,
+               workers = 1, retries = 3, store = None):
+    """
+    Download all activities of the user as TCX files into outdir. The activity list is newest first, so
+    with `incremental` paging stops at the first page that only holds already archived activities, and
+    with `since` (yyyy-mm-dd) it stops at the first activity before that date.
+    The files of each page are fetched by `workers` threads and saved in store (by default as files in
+    outdir, see storage). Every finished page is recorded in a checkpoint, so an interrupted run continues
+    at the page where it stopped; a checkpoint left by a run with other options is ignored. The summaries of
+    all listed activities are added to the dataset of summaries.py in outdir; when archived activities lack
+    one, an incremental run goes on through the whole list once to add them.
+    Returns the activities that could not be downloaded. The checkpoint then stays at the first page holding
+    one of them and the high-water mark is not moved, so the next run tries them again.
+    """
+    global ACTIVITIES
+    if store is None:
+        store = storage.DirectoryStore(outdir)
+    checkpoint = Checkpoint(os.path.join(outdir, CHECKPOINT))
+    options = {'increment': increment, 'incremental': incremental, 'since': since}
+    if checkpoint.get('options') != options:
+        checkpoint.clear()
+    currentIndex = checkpoint.get('start', 0)
+    newest = checkpoint.get('newest')
+    if currentIndex:
+        logger.info('Resuming download for user %s at activity %d', username, currentIndex)
+    initUrl = ACTIVITIES % (currentIndex, increment)  # 100 activities seems a nice round number
+    response = fetch_with_backoff(logger, transport, initUrl, retries)
+    search = json.loads(response.decode('utf-8'))
+    manifest = load_manifest(logger, outdir)
+    state = load_sync_state(outdir)
+    known = summaries.known_activities(outdir)
+    # An archive from before the summaries were kept pages through the whole list once to fill them in
+    backfill = not state.get('summaries') and bool(set(manifest) - known)
+    failed = []
+    reached_end = False
+
+    def worker(thread_transport, job):
+        download_activity(logger, thread_transport, store, outdir, manifest, job[0], job[1], retries, job[2])
+
+    while True:
+        if len(search) == 0:
+            # All done!
+            # print('Download complete')
+            reached_end = True
+            break
+
+        summaries.add_summaries(outdir, known, [summaries.summary_row(item, tcx_sport(item)) for item in search])
+
+        page_known = True
+        reached_since = False
+        jobs = []
+        for item in search:
+            # Read this list of activities and save the files.
 
+            activityId = item['activityId']
+            activityDate = item['startTimeLocal'][:10]
+            sport = tcx_sport(item)
+            if newest is None or item['startTimeLocal'] > newest['startTimeLocal']:
+                newest = {'activityId': str(activityId), 'startTimeLocal': item['startTimeLocal']}
+            if since and activityDate < since:
+                reached_since = True
+                continue
+            if str(activityId) in manifest:
+                logger.info('{}_{}.txt already exists in {}. Skipping.'.format(activityDate, activityId, outdir))
+                if manifest[str(activityId)].get('sport') != sport:
+                    # Archived before the manifest recorded sports, or recorded by a less careful guess
+                    entry = dict(manifest[str(activityId)])
+                    entry.pop('sport', None)
+                    if sport:
+                        entry['sport'] = sport
+                    add_to_manifest(manifest, outdir, entry)
+                continue
+            if 'startTimeLocal' not in state or item['startTimeLocal'] > state['startTimeLocal']:
+                # Newer than the last complete sync. Older missing ones are gaps, fetched but not a reason to keep paging
+                page_known = False
+            jobs.append((activityId, activityDate, sport))
+
+        page_failed = run_pool(logger, transport, jobs, worker, workers)
+        if not failed:
+            # Resume after this page next time, or at it when any of its activities failed
+            checkpoint.update(options=options, start=currentIndex + (increment if not page_failed else 0),
+                              newest=newest)
+        failed.extend(page_failed)
+
+        if reached_since:
+            logger.info('Reached activities before %s, done.', since)
+            break
+        if incremental and page_known and not (backfill and set(manifest) - known):
+            logger.info('Page starting at %d only holds known activities, done.', currentIndex)
+            break
 
-def dailysleep(logger, agent, username, date, display_name, outdir):
-    url = SLEEP % (display_name, date)
+        # We still have at least 1 activity.
+        currentIndex += increment
+        url = ACTIVITIES % (currentIndex, increment)
+        response = fetch_with_backoff(logger, transport, url, retries)
+        search = json.loads(response.decode('utf-8'))
+
+    if failed:
+        logger.warning('%d activities of user %s could not be downloaded', len(failed), username)
+        return failed
+    checkpoint.clear()
+    # Only move the high-water mark after a sync that did not break off halfway
+    synced = dict(state)
+    if newest and ('startTimeLocal' not in state or newest['startTimeLocal'] > state['startTimeLocal']):
+        synced.update(newest)
+    if reached_end or not set(manifest) - known:
+        # Every archived activity that is still on Garmin Connect has its summary now
+        synced['summaries'] = True
+    if synced != state:
+        save_sync_state(outdir, synced)
+    return failed
+
+
+# Wellness data is stored per day as <date>_<kind>.json; kind -> description for the log
+WELLNESS_KINDS = [('wellness', 'wellness'),
+                  ('summary', 'daily summary'),
+                  ('stress', 'daily stress'),
+                  ('heartrate', 'daily heart rate'),
+                  ('sleep', 'daily sleep')]
+
+def wellness_url(kind, date, display_name):
+    if kind == 'wellness':
+        return WELLNESS % (display_name, date, date)
+    elif kind == 'summary':
+        return DAILYSUMMARY % (display_name, date)
+    elif kind == 'stress':
+        return STRESS % (date)
+    elif kind == 'heartrate':
+        return HEARTRATE % (display_name, date)
+    elif kind == 'sleep':
+        return SLEEP % (display_name, date)
+    raise ValueError('Unknown wellness kind {}'.format(kind))
+
+
+def wellness_file(logger, transport, username, kind, date, display_name, store, retries=3):
+    """
+    Download one kind of wellness data for one date into <date>_<kind>.json in store. Returns whether that worked.
+    """
+    description = dict(WELLNESS_KINDS)[kind]
+    url = wellness_url(kind, date, display_name)
     try:
-        response = agent.open(url)
-    except:
-        logger.warning('Wrong credentials for user {}. Skipping daily sleep for {}.'.format(username, date))
-        return
-    content = response.get_data().decode('utf-8')
+        content = fetch_with_backoff(logger, transport, url, retries)
+    except Exception as e:
+        logger.warning('Could not download {} for user {} for {}: {}. Skipping.'.format(description, username, date, e))
+        return False
 
-    file_name = '{}_sleep.json'.format(date)
-    file_path = os.path.join(outdir, file_name)
-    with open(file_path, "w") as f:
-        f.write(content)
+    store.write('{}_{}.json'.format(date, kind), content)
+    return True
 
 
-def login_user(logger, username, password):
-    # Create the agent and log in.
+def login_user(logger, username, password, session_dir=None, reuse=True):
+    """
+    Create the agent and log in. With session_dir, the session cookies are saved there and a saved session
+    that is still valid is used instead of logging in again (unless reuse is False).
+    """
+    # The explicit cookie jar lets download threads share the session, and can be saved to disk.
     agent = me.Browser()
+    agent.set_cookiejar(me.LWPCookieJar())
+    agent.set_handle_robots(False)
+    agent.set_handle_refresh(False)
+    agent.addheaders = [('User-agent', USER_AGENT)]
+
+    if session_dir:
+        file_path = session_file(session_dir, username)
+        if reuse and os.path.exists(file_path):
+            try:
+                load_session(agent, file_path)
+                if session_is_valid(agent):
+                    logger.info('Reusing saved session for %s', username)
+                    return agent
+            except (IOError, me.LoadError, me.URLError) as e:
+                logger.info('Could not reuse saved session for %s: %s', username, e)
+            agent.cookiejar.clear()
+
     logger.info("Attempting to login to Garmin Connect...")
     login(logger, agent, username, password)
+    if session_dir:
+        save_session(agent, session_file(session_dir, username))
     return agent
 
 
-def download_files_for_user(logger, agent, username, output):
+def make_store(folder, compression=None, pack=False):
+    """
+    Where downloaded files go: packed per year (see storage.PackStore) when asked for or when folder
+    already holds packed records, separate files otherwise
+    """
+    if pack:
+        return storage.PackStore(folder, compression)
+    return storage.open_store(folder, compression)
+
+
+def download_files_for_user(logger, agent, username, output, incremental=False, since=None, workers=1, interval=0,
+                            relogin=None, retries=3, compression=None, pack=False):
+    """
+    Download the activities of username into the Historical folder in output, see activities. Returns the
+    activities that could not be downloaded.
+    """
     user_output = os.path.join(output, username)
     download_folder = os.path.join(user_output, 'Historical')
 
@@ -304,10 +935,95 @@ def download_files_for_user(logger, agent, username, output):
         os.makedirs(download_folder)
 
     # Scrape all the activities.
-    activities(logger, agent, username, download_folder)
+    transport = Transport(agent, interval, pool_size=workers, relogin=relogin)
+    store = make_store(download_folder, compression, pack)
+    return activities(logger, transport, username, download_folder, incremental=incremental, since=since,
+                      workers=workers, retries=retries, store=store)
+
+
+def split_wellness_range(content, dates):
+    """
+    Split a wellness response covering several days into one response per date, in the same format
+    as when it was requested for only that date
+    """
+    metrics = content['allMetrics']['metricsMap']
+    result = {}
+    for date in dates:
+        daycontent = dict(content)
+        daycontent['allMetrics'] = dict(content['allMetrics'])
+        daycontent['allMetrics']['metricsMap'] = dict(
+            (key, [value for value in values if value.get('calendarDate') == date])
+            for key, values in metrics.items())
+        result[date] = daycontent
+    return result
+
+
+def wellness_range(logger, transport, username, dates, display_name, store, retries=3):
+    """
+    Download wellness data for a block of consecutive dates in one request, saved as <date>_wellness.json per day.
+    Returns whether that worked.
+    """
+    url = WELLNESS % (display_name, dates[0], dates[-1])
+    try:
+        response = fetch_with_backoff(logger, transport, url, retries)
+    except Exception as e:
+        logger.warning('Could not download wellness for user {} for {} - {}: {}. Skipping.'.format(username, dates[0], dates[-1], e))
+        return False
+    # A body that is not JSON (ValueError) is skipped like one in an unexpected format, so the block counts as
+    # failed and is requested again on the next run instead of stopping the whole download
+    try:
+        perday = split_wellness_range(json.loads(response.decode('utf-8')), dates)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        logger.warning('Unexpected wellness data for {} - {}, skipping.'.format(dates[0], dates[-1]))
+        return False
+
+    for date in dates:
+        store.write('{}_wellness.json'.format(date), json.dumps(perday[date]).encode('utf-8'))
+    return True
+
+
+def chunk_dates(dates, chunk_days):
+    """
+    Sort dates and cut them into blocks of at most chunk_days consecutive days
+    """
+    chunks = []
+    for date in sorted(dates):
+        if chunks and len(chunks[-1]) < chunk_days and \
+                datetime.strptime(date, '%Y-%m-%d') - datetime.strptime(chunks[-1][-1], '%Y-%m-%d') == timedelta(days=1):
+            chunks[-1].append(date)
+        else:
+            chunks.append([date])
+    return chunks
 
 
-def download_wellness_for_user(logger, agent, username, start_date, display_name, output):
+def is_settled(store, name, date, settle_days):
+    """
+    True when date lies more than settle_days in the past and record name in store already holds valid
+    JSON; Garmin does not change those days anymore, so they do not need to be downloaded again
+    """
+    if datetime.strptime(date, '%Y-%m-%d').date() >= datetime.now().date() - timedelta(days=settle_days):
+        return False
+    if name not in store:
+        return False
+    try:
+        return json.loads(store.read(name).decode('utf-8')) is not None
+    except (IOError, ValueError):
+        return False
+
+
+def download_wellness_for_user(logger, agent, username, dates, display_name, output, workers=1, interval=0,
+                               retries=3, chunk_days=30, settle_days=3, force=False, relogin=None, compression=None,
+                               pack=False):
+    """
+    Download all kinds of wellness data for all dates. Only the wellness overview endpoint takes a range of
+    dates, so it is asked for blocks of chunk_days at a time; the daily summary, stress, heart rate and sleep
+    endpoints only take a single date and are asked per (date, kind), so with more than one worker they run
+    concurrently across both endpoints and days.
+    Files of days older than settle_days are kept if present, unless force is set. The last date up to
+    which everything is downloaded is kept in a checkpoint, so running the same range again after an
+    interruption continues from there. Returns the (date, kind) downloads that failed; the checkpoint is not
+    moved past them.
+    """
     user_output = os.path.join(output, username)
     download_folder = os.path.join(user_output, 'Wellness')
 
@@ -315,13 +1031,178 @@ def download_wellness_for_user(logger, agent, username, start_date, display_name
     if not os.path.exists(download_folder):
         os.makedirs(download_folder)
 
-    # Scrape all wellness data.
-    wellness(logger, agent, username, start_date, display_name, download_folder)
-    # Daily summary, stress and heart rate do not do ranges, only fetch for `startdate`
-    dailysummary(logger, agent, username, start_date, display_name, download_folder)
-    dailystress(logger, agent, username, start_date, download_folder)
-    dailyheartrate(logger, agent, username, start_date, display_name, download_folder)
-    dailysleep(logger, agent, username, start_date, display_name, download_folder)
+    checkpoint = Checkpoint(os.path.join(download_folder, CHECKPOINT))
+    requested = [min(dates), max(dates)]
+    if not force and checkpoint.get('dates') == requested and checkpoint.get('completed'):
+        logger.info('Resuming wellness download for %s after %s', username, checkpoint.get('completed'))
+        dates = [date for date in dates if date > checkpoint.get('completed')]
+
+    transport = Transport(agent, interval, pool_size=workers, relogin=relogin)
+    store = make_store(download_folder, compression, pack)
+    failed = []
+
+    def job_dates(job):
+        date, kind = job
+        return date if kind == 'wellness' else [date]
+
+    def worker(thread_transport, job):
+        date, kind = job
+        if kind == 'wellness':
+            logger.info('Downloading wellness for %s - %s...', date[0], date[-1])
+            success = wellness_range(logger, thread_transport, username, date, display_name, store, retries)
+        else:
+            logger.info('Downloading %s for %s...', dict(WELLNESS_KINDS)[kind], date)
+            success = wellness_file(logger, thread_transport, username, kind, date, display_name, store, retries)
+        if success:
+            finished(job)
+        else:
+            failed.append(job)
+
+    def needed(date, kind):
+        if force:
+            return True
+        name = '{}_{}.json'.format(date, kind)
+        if is_settled(store, name, date, settle_days):
+            logger.info('%s already exists, skipping.', name)
+            return False
+        return True
+
+    # Scrape all wellness data. Daily summary, stress, heart rate and sleep do not do ranges, so this is per day
+    wellness_dates = [date for date in dates if needed(date, 'wellness')]
+    jobs = [(chunk, 'wellness') for chunk in chunk_dates(wellness_dates, max(chunk_days, 1))]
+    jobs.extend([(date, kind) for date in dates for kind, _ in WELLNESS_KINDS
+                 if kind != 'wellness' and needed(date, kind)])
+
+    # Count the unfinished jobs per date, to move the checkpoint along in date order
+    pending = {}
+    for job in jobs:
+        for date in job_dates(job):
+            pending[date] = pending.get(date, 0) + 1
+    order = sorted(pending)
+    progress = {'position': 0}
+    lock = threading.Lock()
+
+    def finished(job):
+        with lock:
+            for date in job_dates(job):
+                pending[date] -= 1
+            position = progress['position']
+            while position < len(order) and pending[order[position]] == 0:
+                position += 1
+            if position > progress['position']:
+                progress['position'] = position
+                checkpoint.update(dates=requested, completed=order[position - 1])
+
+    failed.extend(run_pool(logger, transport, jobs, worker, workers))
+    if progress['position'] == len(order):
+        checkpoint.clear()
+    if isinstance(store, storage.PackStore):
+        # Recent days are downloaded again on every run, each time appending another copy to the pack
+        reclaimed = store.compact(min_garbage=COMPACT_GARBAGE)
+        if reclaimed:
+            logger.info('Compacted the packs of %s, reclaiming %d bytes', username, reclaimed)
+    if failed:
+        logger.warning('%d wellness downloads of user %s failed', len(failed), username)
+    return failed
+
+
+def download_for_account(logger, username, password, display_name, args):
+    """
+    Log in as username and download the wellness data (when a start date is given) or else the activities,
+    with the options in args. Returns the downloads that failed.
+    """
+    output = args['output']
+    session_dir = None if args['no_session'] else args['session_dir']
+    interval = args['interval']
+    if interval is None:
+        interval = PARALLEL_INTERVAL if args['workers'] > 1 else 0
+
+    def relogin():
+        return login_user(logger, username, password, session_dir, reuse=False)
+
+    if args['startdate'] is not None:
+        if not display_name:
+            raise ValueError("No displayname for {}".format(username))
+        alldates = get_daterange(args['startdate'], args['enddate'])
+        agent = login_user(logger, username, password, session_dir)
+        return download_wellness_for_user(logger, agent, username, alldates, display_name, output,
+                                          workers=args['workers'], interval=interval, retries=args['retries'],
+                                          chunk_days=args['chunk_days'], settle_days=args['settle_days'],
+                                          force=args['force'], relogin=relogin, compression=args['compress'],
+                                          pack=args['pack'])
+    else:
+        agent = login_user(logger, username, password, session_dir)
+        return download_files_for_user(logger, agent, username, output,
+                                       incremental=args['incremental'], since=args['since'],
+                                       workers=args['workers'], interval=interval, relogin=relogin,
+                                       retries=args['retries'], compression=args['compress'], pack=args['pack'])
+
+
+def read_batch_file(file_path):
+    """
+    Read the accounts from a CSV file with a "username,password[,displayname]" line per account; a password
+    holding a comma has to be quoted ("pass,word"). Empty lines and lines starting with # are skipped.
+    """
+    accounts = []
+    with summaries.open_csv(file_path, 'r') as f:
+        reader = csv.reader(f)
+        for fields in reader:
+            fields = [field.strip() for field in fields]
+            if not any(fields) or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2 or len(fields) > 3:
+                raise ValueError('Line {} of {} is not in "username,password[,displayname]" format'.format(
+                    reader.line_num, file_path))
+            accounts.append((fields[0], fields[1], fields[2] if len(fields) > 2 else None))
+    return accounts
+
+
+def run_batch(logger, accounts, args, workers=1):
+    """
+    Download for all (username, password, display_name) accounts, `workers` accounts at the same time.
+    Every account has its own session, and an account that fails is logged without stopping the others.
+    Returns a (username, error or None, seconds) tuple per account; an account of which some downloads
+    failed counts as failed.
+    """
+    results = []
+    lock = threading.Lock()
+    accountqueue = queue.Queue()
+    for account in accounts:
+        accountqueue.put(account)
+
+    def work():
+        while True:
+            try:
+                username, password, display_name = accountqueue.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            error = None
+            try:
+                failed = download_for_account(logger, username, password, display_name or args['displayname'],
+                                              args)
+                if failed:
+                    error = '{} downloads failed'.format(len(failed))
+            except Exception as e:
+                logger.exception('Download for %s failed', username)
+                error = str(e) or e.__class__.__name__
+            with lock:
+                results.append((username, error, time.time() - started))
+
+    threads = [threading.Thread(target=work) for _ in range(max(1, min(workers, len(accounts))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def print_batch_summary(results):
+    failed = [result for result in results if result[1] is not None]
+    print('Downloaded {} accounts, {} failed'.format(len(results), len(failed)))
+    for username, error, seconds in sorted(results):
+        print('  {:<40} {:>8.1f}s  {}'.format(username, seconds, error or 'OK'))
 
 
 def run_download():
@@ -329,13 +1210,19 @@ def run_download():
 
     parser = argparse.ArgumentParser(description='Garmin Data Scraper',
                                      epilog='Because the hell with APIs!', add_help='How to use',
-                                     prog='python download.py [-u <user> | -c <csv fife with credentials>] [ -s <start_date> -e <end_date> -d <display_name> ] -o <output dir>')
+                                     prog='python download.py [-u <user> | -c <csv fife with credentials> | -b <csv file with accounts>] [ -s <start_date> -e <end_date> -d <display_name> ] -o <output dir>')
     parser.add_argument('-u', '--user', required=False,
                         help='Garmin username. This will NOT be saved!',
                         default=None)
     parser.add_argument('-c', '--csv', required=False,
                         help='CSV file with username and password in "username,password" format.',
                         default=None)
+    parser.add_argument('-b', '--batch', required=False,
+                        help='CSV file with one "username,password[,displayname]" line per account to download',
+                        default=None)
+    parser.add_argument('--accounts', required=False, type=int,
+                        help='Number of accounts from the batch file to download at the same time',
+                        default=1)
     parser.add_argument('-s', '--startdate', required=False,
                         help='Start date for wellness data',
                         default=None)
@@ -345,18 +1232,73 @@ def run_download():
     parser.add_argument('-d', '--displayname', required=False,
                         help='Displayname (see the url when logged into Garmin Connect)',
                         default=None)
+    parser.add_argument('--incremental', action='store_true',
+                        help='Stop paging through activities at the first page with only already downloaded ones')
+    parser.add_argument('--since', required=False,
+                        help='Only download activities from this date (yyyy-mm-dd) onwards',
+                        default=None)
+    parser.add_argument('-w', '--workers', required=False, type=int,
+                        help='Number of activities or wellness files to download at the same time',
+                        default=1)
+    parser.add_argument('--interval', required=False, type=float,
+                        help='Minimum number of seconds between two requests to the same host (default: 0.2 '
+                             'with more than one worker, 0 otherwise)',
+                        default=None)
+    parser.add_argument('--retries', required=False, type=int,
+                        help='Number of times a failed request is retried, with exponential backoff',
+                        default=3)
+    parser.add_argument('--chunk-days', required=False, type=int,
+                        help='Number of days of the wellness overview to request at once; the other wellness '
+                             'files are requested per day',
+                        default=30)
+    parser.add_argument('--settle-days', required=False, type=int,
+                        help='Wellness files of days longer ago than this are not downloaded again',
+                        default=3)
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Download all wellness files again, even when they are already present')
+    parser.add_argument('-z', '--compress', required=False, choices=['gzip', 'zstd'],
+                        help='Store downloaded files compressed (zstd needs the zstandard package)',
+                        default=None)
+    parser.add_argument('--pack', action='store_true',
+                        help='Append downloaded files to one packed file per year instead of writing separate files')
+    parser.add_argument('--session-dir', required=False,
+                        help='Directory where the login session is kept between runs',
+                        default=os.path.join(os.path.expanduser('~'), '.garmin'))
+    parser.add_argument('--no-session', action='store_true',
+                        help='Always log in, do not save or reuse the login session')
     parser.add_argument('-o', '--output', required=False,
                         help='Output directory.', default=os.path.join(os.getcwd(), 'Results/'))
     args = vars(parser.parse_args())
 
     # Sanity check, before we do anything:
-    if args['user'] is None and args['csv'] is None:
-        logger.error("Must either specify a username (-u) or a CSV credentials file (-c).")
+    if args['user'] is None and args['csv'] is None and args['batch'] is None:
+        logger.error("Must either specify a username (-u), a CSV credentials file (-c) or a batch file (-b).")
         sys.exit()
 
-    # Try to use the user argument from command line
-    output = args['output']
+    if args['since'] is not None:
+        try:
+            datetime.strptime(args['since'], '%Y-%m-%d')
+        except ValueError:
+            logger.error("--since must be a date in yyyy-mm-dd format.")
+            sys.exit(1)
+
+    if args['startdate'] is not None and not args['enddate']:
+        logger.error("Provide an enddate")
+        sys.exit(1)
 
+    if args['batch'] is not None:
+        try:
+            accounts = read_batch_file(args['batch'])
+        except (IOError, ValueError) as e:
+            logger.error(e)
+            sys.exit(1)
+        results = run_batch(logger, accounts, args, workers=args['accounts'])
+        print_batch_summary(results)
+        if any(error is not None for _, error, _ in results):
+            sys.exit(1)
+        return
+
+    # Try to use the user argument from command line
     if args['user'] is not None:
         password = getpass('Garmin account password (NOT saved): ')
         username = args['user']
@@ -372,30 +1314,26 @@ def run_download():
             logger.error(e)
             sys.exit()
         try:
-            username, password = contents.strip().split(",")
-        except IndexError:
+            username, password = contents.strip().split(",", 1)
+        except ValueError:
             logger.error("CSV file must only have 1 line, in \"username,password\" format.")
             sys.exit()
 
     # Perform the download.
-    if args['startdate'] is not None:
-        start_date = args['startdate']
-        end_date = args['enddate']
-        display_name = args['displayname']
-        if not end_date:
-            logger.error("Provide an enddate")
-            sys.exit(1)
-        if not display_name:
-            logger.error("Provide a displayname, you can find it in the url of Daily Summary: '.../daily-summary/<displayname>/...'")
-            sys.exit(1)
-        alldates = get_daterange(start_date, end_date)
-        agent = login_user(logger, username, password)
-        for thisdate in alldates:
-            logger.info('Downloading all wellness for %s...', thisdate)
-            download_wellness_for_user(logger, agent, username, thisdate, display_name, output)
-    else:
-        agent = login_user(logger, username, password)
-        download_files_for_user(logger, agent, username, output)
+    if args['startdate'] is not None and not args['displayname']:
+        logger.error("Provide a displayname, you can find it in the url of Daily Summary: '.../daily-summary/<displayname>/...'")
+        sys.exit(1)
+    try:
+        failed = download_for_account(logger, username, password, args['displayname'], args)
+    except LoginError as e:
+        sys.exit(str(e))
+    except (IOError, RateLimited, SessionExpired) as e:
+        # Garmin Connect still failed after the retries, e.g. for the first page of the activity list
+        logger.error('Download for %s failed: %s', username, e)
+        sys.exit('The download failed, see garmindownload.log; run it again to continue.')
+    if failed:
+        sys.exit('{} downloads failed, see garmindownload.log; they are tried again on the next run.'.format(
+            len(failed)))
 
 
 if __name__ == "__main__":
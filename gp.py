@@ -7,48 +7,35 @@ import parser as gcparser
 import os
 import os.path
 import running
+import storage
 
-def main(indir, outdir):
+def main(indir, outdir, workers = None, cachedir = None, sport = 'Running'):
     """
     Main driver method.
     """
-    # Generate a list of all the files.
-    listing = filelisting(indir)
+    # Generate a list of all the files, or of the records when they are packed,
+    # leaving out the activities download.py recorded as another sport without opening them.
+    listing = storage.activity_files(indir, sport)
+    packed = indir if storage.PackStore.present(indir) else None
 
-    # Parse each file.
-    timestamps = []
-    distances = []
-    splits = []
-    i = 0
-    for f in listing:
-        p = gcparser.GCFileParser(f)
-        t, d, s = p.parse()
-        if t is None and d is None and s is None: continue
-
-        # Append the data.
-        timestamps.append(t)
-        distances.append(d)
-        splits.append(s)
-
-        i += 1
-
-        print '.'
+    # Parse all files, using all cores; with a cache, only the ones not parsed before.
+    if cachedir is None:
+        parsed = gcparser.parseMany(listing, sport, workers, packed)
+    else:
+        parsed = gcparser.parseCached(listing, cachedir, sport, workers, packed)
+    print 'Parsed {} runs out of {} files.'.format(len(parsed), len(listing))
 
     # Sort the data.
-    timestamps = np.array(timestamps)
+    timestamps = parsed.timestamps
     numRuns = np.size(timestamps)
     sortInd = np.argsort(timestamps)
 
-    # Loop through the sorted arrays, generating a graph.
+    # Compute the pace of all runs at once, in sorted order, generating a graph.
     X = np.atleast_2d(np.linspace(0, numRuns, numRuns, endpoint = False)).T
-    y = np.zeros(np.size(timestamps))
-    dy = np.zeros(np.size(y))
-    for i in range(0, np.size(sortInd)):
-        ind = sortInd[i]
-        d = running.metersToMiles(distances[ind])
-        s = running.secondsToMinutes(splits[ind])
-        y[i] = running.averagePace(d, s)
-        dy[i] = np.std(s)
+    d = running.metersToMiles(parsed.distances)
+    s = running.secondsToMinutes(parsed.times)
+    y = running.averagePaces(d, s, parsed.offsets)[sortInd]
+    dy = running.splitDeviations(s, parsed.offsets)[sortInd]
 
     dy += 0.01
     process = gp.GaussianProcess(corr = 'squared_exponential',
@@ -76,17 +63,6 @@ def main(indir, outdir):
     plot.legend(loc = 0)
     plot.show()
 
-def filelisting(directory, suffix = 'tcx'):
-    """
-    Generates a list of all the files in the directory.
-    """
-    files = []
-    for f in os.listdir(directory):
-        fullpath = os.path.join(directory, f)
-        if os.path.isfile(fullpath) and f.endswith(suffix):
-            files.append(fullpath)
-    return files
-
 if __name__ == "__main__":
     print 'Guinea pigs, that is!\n'
     print "                             ,   ,        "
@@ -104,6 +80,17 @@ if __name__ == "__main__":
         help = 'Input directory, contains lots of .tcx files.')
     parser.add_argument('-o', '--output', required = False,
         default = None, help = 'Output directory.')
+    parser.add_argument('-w', '--workers', type = int, required = False,
+        default = None, help = 'Number of processes parsing files (default: one per core).')
+    parser.add_argument('-s', '--sport', required = False, default = 'Running',
+        help = 'Sport of the activities to use, as in the TCX files (default: Running).')
+    parser.add_argument('--cache', required = False, default = None,
+        help = 'Directory to cache parsed files in (default: .parsecache in the input directory).')
+    parser.add_argument('--no-cache', dest = 'nocache', action = 'store_true',
+        help = 'Parse all files again, without using or updating the cache.')
 
     args = vars(parser.parse_args())
-    main(args['input'], args['output'])
+    cachedir = args['cache'] or os.path.join(args['input'], '.parsecache')
+    if args['nocache']:
+        cachedir = None
+    main(args['input'], args['output'], args['workers'], cachedir, args['sport'])
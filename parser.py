@@ -1,14 +1,124 @@
 import sys
+import json
+import multiprocessing
+import os
 import xml.parsers.expat
 import matplotlib.pyplot as plot
 import numpy as np
-from datetime import datetime
-import time
+import calendar
 from scipy import stats
 
+import storage
+
+# Columns of the trackpoint arrays, see GCFileParser.
+TRACK_FIELDS = ['time', 'distance', 'heartrate', 'cadence', 'altitude', 'latitude', 'longitude']
+
+# Element inside a Trackpoint -> column its value goes to.
+TRACK_COLUMNS = {
+    'Time': 0,
+    'DistanceMeters': 1,
+    'Cadence': 3,
+    'ns3:RunCadence': 3,
+    'AltitudeMeters': 4,
+    'LatitudeDegrees': 5,
+    'LongitudeDegrees': 6,
+}
+
+# Width of the byte strings isoToEpochArray works on; enough for nanoseconds and an offset.
+ISO_WIDTH = 40
+
+# Date (yyyy-mm-dd) -> seconds since the epoch at its midnight UTC, see isoToEpoch.
+_midnights = {}
+
+def isoToEpoch(data):
+    """
+    Converts an ISO-8601 timestamp such as 2018-01-01T10:00:00.000Z to seconds
+    since the epoch. Fractional seconds are optional and may have any number
+    of digits; the time zone is Z (UTC) or an offset like +02:00.
+    """
+    midnight = _midnights.get(data[:10])
+    if midnight is None:
+        midnight = calendar.timegm((int(data[0:4]), int(data[5:7]), int(data[8:10]), 0, 0, 0))
+        _midnights[data[:10]] = midnight
+    seconds = midnight + int(data[11:13]) * 3600 + int(data[14:16]) * 60 + int(data[17:19])
+    end = 19
+    if data[19:20] == '.':
+        end = 20
+        while end < len(data) and data[end].isdigit():
+            end += 1
+        seconds += float(data[19:end])
+    zone = data[end:]
+    if zone and zone != 'Z':
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '+':
+            seconds -= offset
+        else:
+            seconds += offset
+    return seconds
+
+def daysFromCivil(year, month, day):
+    """
+    Number of days since 1970-01-01 of the given dates; works on arrays.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yearOfEra = year - era * 400
+    dayOfYear = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+    dayOfEra = yearOfEra * 365 + yearOfEra // 4 - yearOfEra // 100 + dayOfYear
+    return era * 146097 + dayOfEra - 719468
+
+def isoToEpochArray(values):
+    """
+    Vectorized isoToEpoch: converts a sequence (or array) of ISO-8601 timestamps
+    to an array of seconds since the epoch, shape (N,). Empty strings become NaN.
+
+    The strings are handled as a matrix of characters, so no Python object is
+    created per timestamp.
+    """
+    raw = np.asarray(values, dtype = 'S%d' % ISO_WIDTH)
+    n = np.size(raw)
+    chars = raw.view(np.uint8).reshape(n, ISO_WIDTH).astype(np.int64)
+    digits = chars - ord('0')
+
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    seconds = (daysFromCivil(year, month, day) * 86400 + (digits[:, 11] * 10 + digits[:, 12]) * 3600 +
+        (digits[:, 14] * 10 + digits[:, 15]) * 60 + digits[:, 17] * 10 + digits[:, 18]).astype(np.float64)
+
+    # Fractional seconds: the run of digits following a '.' at position 19.
+    isDigit = (chars >= ord('0')) & (chars <= ord('9'))
+    hasFraction = chars[:, 19] == ord('.')
+    fraction = np.cumprod(isDigit[:, 20:], axis = 1).astype(bool) & hasFraction[:, np.newaxis]
+    scale = 10.0 ** -np.arange(1, ISO_WIDTH - 19)
+    seconds += (digits[:, 20:] * fraction * scale).sum(axis = 1)
+
+    # Time zone: Z, nothing, or +hh:mm / -hh:mm right after the seconds.
+    zone = 19 + np.where(hasFraction, 1 + fraction.sum(axis = 1), 0)
+    rows = np.arange(n)
+    sign = chars[rows, np.minimum(zone, ISO_WIDTH - 1)]
+    field = lambda offset: digits[rows, np.minimum(zone + offset, ISO_WIDTH - 1)]
+    offset = (field(1) * 10 + field(2)) * 3600 + (field(4) * 10 + field(5)) * 60
+    seconds -= np.where(sign == ord('+'), offset, 0)
+    seconds += np.where(sign == ord('-'), offset, 0)
+
+    seconds[chars[:, 0] == 0] = np.nan
+    return seconds
+
+class WrongSport(Exception):
+    """
+    Raised from the expat handlers to stop parsing a file of another sport.
+    """
+    pass
+
 class GCFileParser:
+    """
+    Parses a TCX file into its lap splits. With trackpoints = True, the
+    Trackpoint elements are collected as well, straight into NumPy arrays
+    that grow by doubling; values missing from a point are NaN.
+    """
 
-    def __init__(self, filename, sport = 'Running'):
+    def __init__(self, filename, sport = 'Running', fileobj = None, trackpoints = False, capacity = 4096):
         self.parser = xml.parsers.expat.ParserCreate()
         self.parser.buffer_text = True
         self.parser.StartElementHandler = self._startElement
@@ -16,6 +126,7 @@ class GCFileParser:
         self.parser.CharacterDataHandler = self._characterData
 
         self.filename = filename
+        self.fileobj = fileobj
         self.isSport = False
         self.wrongSport = False
         self.isDistance = False
@@ -28,21 +139,71 @@ class GCFileParser:
 
         self.sport = sport
 
+        # Trackpoint mode.
+        self.trackpoints = trackpoints
+        self.isPoint = False
+        self.isHeartRate = False
+        self.column = None
+        self.numPoints = 0
+        if trackpoints:
+            self.track = np.empty((len(TRACK_FIELDS), capacity))
+            # Trackpoint times are kept as bytes and converted all at once.
+            self.timeStrings = np.empty(capacity, dtype = 'S%d' % ISO_WIDTH)
+
     def parse(self):
-        # Read the TCX file and parse it.
-        f = open(self.filename)
-        self.parser.ParseFile(f)
-        f.close()
+        # Read the TCX file (possibly compressed, or a record of a pack) and parse it.
+        if self.fileobj is not None:
+            f = self.fileobj
+        else:
+            f = storage.open_file(self.filename)
+        try:
+            self.parser.ParseFile(f)
+        except WrongSport:
+            # The rest of the file does not matter.
+            pass
+        finally:
+            f.close()
+        if self.trackpoints:
+            self.track[0, :self.numPoints] = isoToEpochArray(self.timeStrings[:self.numPoints])
 
         # All done!
         if self.wrongSport is True:
             return [None, None, None]
         return [self.timestamp, np.array(self.splits), np.array(self.times)]
 
+    def points(self):
+        """
+        Returns the trackpoints as a dict of TRACK_FIELDS -> array, shape (N,).
+        Times are seconds since the epoch.
+        """
+        return dict(zip(TRACK_FIELDS, self.track[:, :self.numPoints]))
+
+    def _addPoint(self):
+        if self.numPoints == self.track.shape[1]:
+            capacity = max(1, 2 * self.numPoints)
+            grown = np.empty((len(TRACK_FIELDS), capacity))
+            grown[:, :self.numPoints] = self.track
+            self.track = grown
+            self.timeStrings = np.resize(self.timeStrings, capacity)
+        self.track[:, self.numPoints] = np.nan
+        self.timeStrings[self.numPoints] = b''
+        self.numPoints += 1
+
     def _startElement(self, name, attrs):
-        if name == 'Activity':
+        if self.isPoint:
+            if name == 'HeartRateBpm':
+                self.isHeartRate = True
+            elif name == 'Value' and self.isHeartRate:
+                self.column = 2
+            else:
+                self.column = TRACK_COLUMNS.get(name)
+        elif name == 'Trackpoint' and self.trackpoints and self.isTrack:
+            self.isPoint = True
+            self._addPoint()
+        elif name == 'Activity':
             if attrs['Sport'] != self.sport:
                 self.wrongSport = True
+                raise WrongSport(attrs['Sport'])
             else:
                 self.isSport = True
         elif self.isSport and name == 'TotalTimeSeconds':
@@ -55,7 +216,12 @@ class GCFileParser:
             self.isId = True
 
     def _endElement(self, name):
-        if name == 'Activity' and self.isSport:
+        self.column = None
+        if name == 'Trackpoint':
+            self.isPoint = False
+        elif name == 'HeartRateBpm':
+            self.isHeartRate = False
+        elif name == 'Activity' and self.isSport:
             # Clean up.
             self.isSport = False
         elif name == 'TotalTimeSeconds':
@@ -68,16 +234,181 @@ class GCFileParser:
             self.isId = False
 
     def _characterData(self, data):
-        if self.isTime:
+        if self.column == 0:
+            self.timeStrings[self.numPoints - 1] = data
+        elif self.column is not None:
+            self.track[self.column, self.numPoints - 1] = float(data)
+        elif self.isTime:
             self.times.append(float(data))
         elif self.isDistance and not self.isTrack:
             self.splits.append(float(data))
         elif self.isId:
-            self.timestamp = int(time.mktime(datetime.strptime(data, "%Y-%m-%dT%H:%M:%S.000Z").timetuple()))
+            self.timestamp = int(isoToEpoch(data))
+
+class ParsedActivities:
+    """
+    Columnar result of parseMany: activity i started at timestamps[i] and has
+    the lap splits distances[offsets[i]:offsets[i + 1]], taking
+    times[offsets[i]:offsets[i + 1]] seconds. paths[i] is the file it came from.
+    """
+
+    def __init__(self, paths, timestamps, distances, times, offsets):
+        self.paths = paths
+        self.timestamps = timestamps
+        self.distances = distances
+        self.times = times
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.paths)
+
+    def splits(self, i):
+        """
+        Returns the distances and times of the splits of activity i.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [self.distances[start:end], self.times[start:end]]
+
+# PackStore a worker process reads records from, see _parseOne.
+_store = None
+
+def _parseOne(job):
+    global _store
+    path, sport, directory = job
+    if directory is None:
+        return GCFileParser(path, sport).parse()
+    if _store is None or _store.directory != directory:
+        _store = storage.PackStore(directory)
+    return GCFileParser(path, sport, fileobj = _store.open(path)).parse()
+
+def parseMany(paths, sport = 'Running', workers = None, directory = None):
+    """
+    Parses many TCX files, spread over a pool of worker processes (by default
+    one per core), and returns the activities of the given sport as
+    ParsedActivities, in the order of paths. When directory is given, paths
+    are the names of records packed in it (see storage.PackStore).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    jobs = [(path, sport, directory) for path in paths]
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            # Hand out the files in chunks, a few per worker, to keep the overhead of passing them down.
+            results = pool.map(_parseOne, jobs, max(1, len(jobs) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_parseOne(job) for job in jobs]
+
+    found = [(path, result) for path, result in zip(paths, results) if result[0] is not None]
+    # A Lap has both its distance and its time, but do not trust a file blindly.
+    lengths = [min(len(result[1]), len(result[2])) for _, result in found]
+    offsets = np.zeros(len(found) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    distances = np.zeros(offsets[-1])
+    times = np.zeros(offsets[-1])
+    for i, (_, result) in enumerate(found):
+        distances[offsets[i]:offsets[i + 1]] = result[1][:lengths[i]]
+        times[offsets[i]:offsets[i + 1]] = result[2][:lengths[i]]
+    timestamps = np.array([result[0] for _, result in found], dtype = np.int64)
+    return ParsedActivities([path for path, _ in found], timestamps, distances, times, offsets)
+
+# Arrays of ParsedActivities kept in a parse cache, see parseCached.
+CACHE_ARRAYS = ['timestamps', 'distances', 'times', 'offsets']
+
+def _stamp(path, store):
+    """
+    What has to stay the same for the cached parse of path to be valid: its
+    modification time and size, or where it is in the pack.
+    """
+    if store is None:
+        info = os.stat(path)
+        return [info.st_mtime, info.st_size]
+    entry = store.index(path[:4])[path]
+    return [entry['offset'], entry['length']]
+
+def _loadCache(cacheDir, sport):
+    """
+    Returns the index of the parse cache in cacheDir and its arrays, memory
+    mapped; an empty index when there is no cache (for sport) yet.
+    """
+    indexPath = os.path.join(cacheDir, 'index.json')
+    if not os.path.exists(indexPath):
+        return [{'generation': 0, 'sport': sport, 'files': {}, 'order': []}, None]
+    with open(indexPath, 'r') as f:
+        index = json.load(f)
+    if index['sport'] != sport:
+        return [{'generation': index['generation'], 'sport': sport, 'files': {}, 'order': []}, None]
+    arrays = [np.load(os.path.join(cacheDir, '{}.{}.npy'.format(name, index['generation'])), mmap_mode = 'r')
+              for name in CACHE_ARRAYS]
+    return [index, ParsedActivities(index['order'], *arrays)]
+
+def _saveCache(cacheDir, index, parsed):
+    """
+    Writes the arrays of parsed under a new generation, then the index
+    pointing at them, so an interrupted write leaves the old cache intact.
+    """
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    old = index['generation']
+    index['generation'] = old + 1
+    index['order'] = parsed.paths
+    for name in CACHE_ARRAYS:
+        with storage.atomic_write(os.path.join(cacheDir, '{}.{}.npy'.format(name, index['generation']))) as f:
+            np.save(f, getattr(parsed, name))
+    with storage.atomic_write(os.path.join(cacheDir, 'index.json')) as f:
+        f.write(json.dumps(index).encode('utf-8'))
+    for name in CACHE_ARRAYS:
+        oldPath = os.path.join(cacheDir, '{}.{}.npy'.format(name, old))
+        if os.path.exists(oldPath):
+            os.remove(oldPath)
+
+def parseCached(paths, cacheDir, sport = 'Running', workers = None, directory = None):
+    """
+    parseMany, but remembering the results in cacheDir: only files that are
+    new or changed since the previous run (see _stamp) are parsed. When
+    nothing changed, the arrays are memory mapped straight from the cache.
+    """
+    index, cached = _loadCache(cacheDir, sport)
+    store = storage.PackStore(directory) if directory is not None else None
+    stamps = dict((path, _stamp(path, store)) for path in paths)
+    files = index['files']
+    todo = [path for path in paths if path not in files or files[path]['stamp'] != stamps[path]]
+    if not todo and cached is not None and len(files) == len(paths):
+        # Nothing new: return the cached arrays if they hold exactly the activities asked for.
+        if [path for path in paths if files[path]['row'] is not None] == cached.paths:
+            return cached
+
+    parsed = parseMany(todo, sport, workers, directory)
+    fresh = dict((path, i) for i, path in enumerate(parsed.paths))
+    found = []
+    for path in paths:
+        if path in fresh:
+            found.append([path, parsed.timestamps[fresh[path]]] + parsed.splits(fresh[path]))
+        elif path not in todo and files[path]['row'] is not None:
+            row = files[path]['row']
+            found.append([path, cached.timestamps[row]] + cached.splits(row))
+
+    offsets = np.zeros(len(found) + 1, dtype = np.int64)
+    offsets[1:] = np.cumsum([len(item[2]) for item in found])
+    result = ParsedActivities([item[0] for item in found],
+        np.array([item[1] for item in found], dtype = np.int64),
+        np.concatenate([np.zeros(0)] + [item[2] for item in found]),
+        np.concatenate([np.zeros(0)] + [item[3] for item in found]),
+        offsets)
+    rows = dict((path, i) for i, path in enumerate(result.paths))
+    index['files'] = dict((path, {'stamp': stamps[path], 'row': rows.get(path)}) for path in paths)
+    _saveCache(cacheDir, index, result)
+    return result
 
 if __name__ == '__main__':
-    analyze = GCFileParser(sys.argv[1])
+    analyze = GCFileParser(sys.argv[1], trackpoints = '--trackpoints' in sys.argv)
     ts, distances, times = analyze.parse()
     print distances
     print times
     print ts
+    if analyze.trackpoints:
+        for field, values in sorted(analyze.points().items()):
+            print field, values
@@ -3,8 +3,24 @@ import numpy as np
 """
 Think of this as a "running" API: it contains useful methods for computing
 various running statistics.
+
+The batch methods work on many activities at once, concatenated into one
+array: activity i is values[offsets[i]:offsets[i + 1]], as in the
+ParsedActivities of parser.parseMany (lap splits) or trackpoint arrays
+(see GCFileParser.points) put one after the other.
 """
 
+# Standard distances (in meters) for bestEfforts.
+STANDARD_DISTANCES = {
+    '400m': 400.0,
+    '1k': 1000.0,
+    '1 mile': 1609.344,
+    '5k': 5000.0,
+    '10k': 10000.0,
+    'half marathon': 21097.5,
+    'marathon': 42195.0,
+}
+
 def averagePace(distances, paces):
     """
     Computes the average pace.
@@ -34,3 +50,279 @@ def secondsToMinutes(times):
     Converts splits in seconds to minutes.
     """
     return times / 60.0
+
+def segmentSums(values, offsets):
+    """
+    Sums the values of each activity.
+
+    Parameters
+    ----------
+    values : array, shape (N,)
+        Values of all activities, concatenated.
+    offsets : array, shape (M + 1,)
+        Start of each activity in values, followed by N.
+
+    Returns
+    -------
+    sums : array, shape (M,)
+        Sum per activity; 0 for an activity without values.
+    """
+    offsets = np.asarray(offsets)
+    nonEmpty = offsets[:-1] < offsets[1:]
+    sums = np.zeros(np.size(offsets) - 1)
+    if np.any(nonEmpty):
+        sums[nonEmpty] = np.add.reduceat(values, offsets[:-1][nonEmpty])
+    return sums
+
+def segmentIndex(offsets):
+    """
+    Returns the activity each of the N values belongs to, shape (N,).
+    """
+    offsets = np.asarray(offsets)
+    return np.repeat(np.arange(np.size(offsets) - 1), np.diff(offsets))
+
+def averagePaces(distances, times, offsets):
+    """
+    Computes the average pace of every activity: averagePace over a batch.
+
+    Parameters
+    ----------
+    distances : array, shape (N,)
+        Split distances of all activities, concatenated.
+    times : array, shape (N,)
+        Times of the splits.
+    offsets : array, shape (M + 1,)
+        Start of each activity, see segmentSums.
+
+    Returns
+    -------
+    paces : array, shape (M,)
+        Time per unit of distance of each activity.
+    """
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return segmentSums(times, offsets) / segmentSums(distances, offsets)
+
+def splitDeviations(values, offsets):
+    """
+    Computes the standard deviation of the splits of every activity, shape (M,).
+    """
+    counts = np.diff(offsets)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        means = segmentSums(values, offsets) / counts
+        squares = segmentSums((values - np.repeat(means, counts)) ** 2, offsets)
+        return np.sqrt(squares / counts)
+
+def fillGaps(values, offsets):
+    """
+    Replaces missing (NaN) trackpoint values by the last value before them in
+    the same activity, or by the first value after them at its start. An
+    activity without any value stays NaN.
+    """
+    values = np.array(values, dtype = float)
+    offsets = np.asarray(offsets)
+    count = np.size(values)
+    starts = np.repeat(offsets[:-1], np.diff(offsets))
+    ends = np.repeat(offsets[1:], np.diff(offsets))
+    missing = np.isnan(values)
+    # Index of the last value up to each point, and of the first value from it.
+    before = np.maximum.accumulate(np.where(missing, -1, np.arange(count)))
+    after = np.minimum.accumulate(np.where(missing, count, np.arange(count))[::-1])[::-1]
+    # Only fill from within the same activity.
+    filled = np.full(count, np.nan)
+    useAfter = (after < ends) & (before < starts)
+    useBefore = before >= starts
+    filled[useBefore] = values[before[useBefore]]
+    filled[useAfter] = values[after[useAfter]]
+    return filled
+
+def _monotonic(distances, offsets):
+    """
+    Cumulative distances of all activities shifted so that they keep
+    increasing over the boundaries between activities, for searchsorted.
+    Activities without any distance count as not moving.
+    """
+    distances = np.where(np.isnan(distances), 0.0, distances)
+    span = np.max(distances) + 1.0 if np.size(distances) else 1.0
+    return distances + segmentIndex(offsets) * span, span
+
+def rollingPace(times, distances, offsets, window = 60.0):
+    """
+    Computes the pace over the last window seconds at every trackpoint.
+
+    Parameters
+    ----------
+    times : array, shape (N,)
+        Trackpoint times in seconds, of all activities concatenated.
+    distances : array, shape (N,)
+        Cumulative distance at each trackpoint, in meters.
+    offsets : array, shape (M + 1,)
+        Start of each activity, see segmentSums.
+    window : float
+        Length of the window in seconds.
+
+    Returns
+    -------
+    paces : array, shape (N,)
+        Seconds per meter over the window ending at each point; NaN where
+        no distance was covered.
+    """
+    times = fillGaps(times, offsets)
+    distances = fillGaps(distances, offsets)
+    shifted, _ = _monotonic(times - times[np.repeat(np.asarray(offsets)[:-1], np.diff(offsets))], offsets)
+    first = np.searchsorted(shifted, shifted - window, side = 'left')
+    first = np.maximum(first, np.repeat(np.asarray(offsets)[:-1], np.diff(offsets)))
+    covered = distances - distances[first]
+    elapsed = times - times[first]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return np.where(covered > 0, elapsed / covered, np.nan)
+
+def bestEfforts(times, distances, offsets, targets = None):
+    """
+    Finds the fastest time over standard distances in every activity.
+
+    Parameters
+    ----------
+    times, distances, offsets :
+        Trackpoints of all activities, see rollingPace.
+    targets : dict
+        Name -> distance in meters; STANDARD_DISTANCES by default.
+
+    Returns
+    -------
+    efforts : dict
+        Name -> array, shape (M,), of the fastest time in seconds of each
+        activity over that distance; NaN for activities shorter than it.
+    """
+    targets = targets or STANDARD_DISTANCES
+    times = fillGaps(times, offsets)
+    distances = fillGaps(distances, offsets)
+    starts = np.repeat(np.asarray(offsets)[:-1], np.diff(offsets))
+    shifted, _ = _monotonic(distances, offsets)
+    efforts = {}
+    for name, target in targets.items():
+        # Last point at least target meters before each point, within the activity.
+        before = np.searchsorted(shifted, shifted - target, side = 'right') - 1
+        valid = before >= starts
+        before = np.maximum(before, starts)
+        after = np.minimum(before + 1, np.size(times) - 1)
+        # Interpolate the time at exactly target meters before the point.
+        step = distances[after] - distances[before]
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            fraction = np.where(step > 0, (distances - target - distances[before]) / step, 0.0)
+        start = times[before] + np.clip(fraction, 0.0, 1.0) * (times[after] - times[before])
+        durations = np.where(valid, times - start, np.inf)
+        best = np.full(np.size(offsets) - 1, np.inf)
+        np.minimum.at(best, segmentIndex(offsets), durations)
+        best[np.isinf(best)] = np.nan
+        efforts[name] = best
+    return efforts
+
+def gradeAdjustedPaces(times, distances, altitudes, offsets):
+    """
+    Computes the grade adjusted pace of every activity: the pace on flat
+    ground taking the same effort, using the energy cost of running on a
+    slope of Minetti et al. (2002).
+
+    Parameters
+    ----------
+    times, distances, offsets :
+        Trackpoints of all activities, see rollingPace.
+    altitudes : array, shape (N,)
+        Altitude in meters at each trackpoint.
+
+    Returns
+    -------
+    paces : array, shape (M,)
+        Seconds per meter of each activity; NaN for one without altitudes.
+    """
+    times = fillGaps(times, offsets)
+    distances = fillGaps(distances, offsets)
+    altitudes = fillGaps(altitudes, offsets)
+    # Steps between consecutive points of the same activity.
+    steps = np.ones(np.size(times), dtype = bool)
+    steps[np.asarray(offsets)[:-1][np.diff(offsets) > 0]] = False
+    run = np.diff(distances, prepend = 0.0)
+    rise = np.diff(altitudes, prepend = 0.0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        grade = np.clip(np.where(run > 0, rise / run, 0.0), -0.45, 0.45)
+    cost = 155.4 * grade ** 5 - 30.4 * grade ** 4 - 43.3 * grade ** 3 + 46.3 * grade ** 2 + 19.5 * grade + 3.6
+    flat = np.where(steps, run * cost / 3.6, 0.0)
+    elapsed = np.where(steps, np.diff(times, prepend = 0.0), 0.0)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return segmentSums(elapsed, offsets) / segmentSums(flat, offsets)
+
+def trimp(times, heartrates, offsets, restHR, maxHR, female = False):
+    """
+    Computes the training load (TRIMP, Banister's training impulse) of every
+    activity from its heart rate.
+
+    Parameters
+    ----------
+    times, offsets :
+        Trackpoints of all activities, see rollingPace.
+    heartrates : array, shape (N,)
+        Heart rate in beats per minute at each trackpoint.
+    restHR, maxHR : float
+        Resting and maximum heart rate of the athlete.
+    female : bool
+        Use the weighting for women instead of for men.
+
+    Returns
+    -------
+    trimps : array, shape (M,)
+        Training load of each activity; NaN for one without any heart rate.
+    """
+    a, b = (0.86, 1.67) if female else (0.64, 1.92)
+    times = fillGaps(times, offsets)
+    heartrates = fillGaps(heartrates, offsets)
+    steps = np.ones(np.size(times), dtype = bool)
+    steps[np.asarray(offsets)[:-1][np.diff(offsets) > 0]] = False
+    minutes = np.where(steps, np.diff(times, prepend = 0.0), 0.0) / 60.0
+    reserve = np.clip((heartrates - restHR) / float(maxHR - restHR), 0.0, 1.0)
+    loads = segmentSums(np.nan_to_num(minutes * reserve * a * np.exp(b * reserve)), offsets)
+    measured = segmentSums(~np.isnan(heartrates), offsets) > 0
+    return np.where(measured, loads, np.nan)
+
+def kilometerSplits(times, distances, offsets, split = 1000.0):
+    """
+    Computes the time of every whole kilometer (or other split distance) of
+    every activity.
+
+    Parameters
+    ----------
+    times, distances, offsets :
+        Trackpoints of all activities, see rollingPace.
+    split : float
+        Split distance in meters.
+
+    Returns
+    -------
+    splits : array, shape (K,)
+        Seconds taken by each split, of all activities concatenated.
+    splitOffsets : array, shape (M + 1,)
+        Start of the splits of each activity.
+    """
+    times = fillGaps(times, offsets)
+    distances = fillGaps(distances, offsets)
+    offsets = np.asarray(offsets)
+    nonEmpty = np.diff(offsets) > 0
+    first = np.where(nonEmpty, offsets[:-1], 0)
+    last = np.where(nonEmpty, offsets[1:] - 1, 0)
+    start = np.where(nonEmpty, distances[first], 0.0)
+    whole = np.floor((distances[last] - start) / split)
+    counts = np.where(nonEmpty & ~np.isnan(whole), whole, 0).astype(np.int64)
+    splitOffsets = np.zeros(np.size(counts) + 1, dtype = np.int64)
+    splitOffsets[1:] = np.cumsum(counts)
+
+    # Distance of every split mark (including the start), in the shifted
+    # distances of _monotonic, so one interpolation covers all activities.
+    shifted, span = _monotonic(distances, offsets)
+    activity = np.repeat(np.arange(np.size(counts)), counts + 1)
+    number = np.arange(np.size(activity)) - np.repeat(splitOffsets[:-1] + np.arange(np.size(counts)), counts + 1)
+    marks = start[activity] + number * split + activity * span
+    markTimes = np.interp(marks, shifted, times)
+    # Every activity's marks start with its start; drop the differences across activities.
+    differences = np.diff(markTimes)
+    keep = np.ones(np.size(differences), dtype = bool)
+    keep[(splitOffsets[1:] + np.arange(np.size(counts)))[:-1]] = False
+    return differences[keep], splitOffsets
@@ -0,0 +1,529 @@
+"""
+Storage of the downloaded files, shared by download.py and the scripts reading its results.
+
+Files are written atomically: data goes to a temporary file next to the target, which is only renamed
+into place once it is complete, so a crash never leaves a truncated file behind. Optionally they are
+compressed with gzip or zstd (the latter needs the zstandard package); readers recognise this from the
+file extension and decompress transparently.
+
+Instead of one file per activity or wellness day, files can also be kept in a PackStore: one file per
+year that records are appended to, with an index of offsets, so that reading one record does not need
+any directory listing. DirectoryStore and PackStore have the same interface; open_store picks the
+right one for a directory. A record that is written again is appended once more, so packs of data that
+gets downloaded repeatedly grow until they are compacted:
+
+    python storage.py -d ~/garmin/username/Wellness
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    # Keeps processes writing to the same pack apart; not available on Windows
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Compression -> extension appended to the file name
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Activities as download.py names them: <date>_<activity id>.txt
+ACTIVITY_RE = re.compile(r'^(\d{4}-\d{2}-\d{2})_(\d+)\.txt$')
+
+
+def strip_compression(file_name):
+    """
+    File name without the extension of its compression, if any
+    """
+    for extension in EXTENSIONS.values():
+        if extension and file_name.endswith(extension):
+            return file_name[:-len(extension)]
+    return file_name
+
+
+def find_file(file_path):
+    """
+    Path of file_path as it was stored, possibly compressed, or None if it does not exist
+    """
+    for extension in ['', '.gz', '.zst']:
+        if os.path.exists(file_path + extension):
+            return file_path + extension
+    return None
+
+
+@contextmanager
+def atomic_write(file_path, compression=None):
+    """
+    Context manager giving a binary file to write the contents of file_path to. The file only appears, with
+    the extension of the compression added, when the block finishes without an exception. It then replaces
+    any copy of file_path stored with another compression.
+    """
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('zstd compression needs the zstandard package')
+    final_path = file_path + EXTENSIONS[compression]
+    tmp_path = final_path + '.part'
+    raw = open(tmp_path, 'wb')
+    try:
+        if compression == 'gzip':
+            f = gzip.GzipFile(filename='', mode='wb', fileobj=raw)
+            yield f
+            f.close()
+        elif compression == 'zstd':
+            f = zstandard.ZstdCompressor().stream_writer(raw)
+            yield f
+            f.flush(zstandard.FLUSH_FRAME)
+        else:
+            yield raw
+        raw.flush()
+        os.fsync(raw.fileno())
+        raw.close()
+        os.rename(tmp_path, final_path)
+    except BaseException:
+        raw.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    for extension in EXTENSIONS.values():
+        if file_path + extension != final_path and os.path.exists(file_path + extension):
+            os.remove(file_path + extension)
+
+
+def write_file(file_path, data, compression=None):
+    """
+    Atomically write the bytes in data to file_path, see atomic_write. Returns the path written.
+    """
+    with atomic_write(file_path, compression) as f:
+        f.write(data)
+    return file_path + EXTENSIONS[compression]
+
+
+def open_file(file_path, mode='rb'):
+    """
+    Open file_path for reading, decompressing it when its name ends in .gz or .zst. mode is 'rb' or 'r'
+    (UTF-8 text).
+    """
+    if file_path.endswith('.gz'):
+        f = gzip.open(file_path, 'rb')
+    elif file_path.endswith('.zst'):
+        if zstandard is None:
+            raise IOError('Reading {} needs the zstandard package'.format(file_path))
+        with open(file_path, 'rb') as raw:
+            f = io.BytesIO(zstandard.ZstdDecompressor().decompressobj().decompress(raw.read()))
+    else:
+        f = io.open(file_path, 'rb')
+    if mode == 'r':
+        return io.TextIOWrapper(f, encoding='utf-8')
+    return f
+
+
+def read_json(file_path):
+    with open_file(file_path, 'r') as f:
+        return json.load(f)
+
+
+def compress(data, compression=None):
+    if compression == 'gzip':
+        buf = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf) as f:
+            f.write(data)
+        return buf.getvalue()
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress(data, compression=None):
+    if compression == 'gzip':
+        with gzip.GzipFile(mode='rb', fileobj=io.BytesIO(data)) as f:
+            return f.read()
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise IOError('Reading zstd compressed data needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+class DirectoryStore(object):
+    """
+    Every record is a file of the same name in directory, see atomic_write
+    """
+
+    def __init__(self, directory, compression=None):
+        self.directory = directory
+        self.compression = compression
+
+    def names(self):
+        return [strip_compression(name) for name in os.listdir(self.directory)
+                if not name.endswith('.part') and os.path.isfile(os.path.join(self.directory, name))]
+
+    def path(self, name):
+        """
+        Path of the file holding record name, or None
+        """
+        return find_file(os.path.join(self.directory, name))
+
+    def __contains__(self, name):
+        return self.path(name) is not None
+
+    def stamp(self, name):
+        """
+        What changes when record name is written again: modification time and size of its file
+        """
+        info = os.stat(self.path(name))
+        return [info.st_mtime, info.st_size]
+
+    def write(self, name, data):
+        return write_file(os.path.join(self.directory, name), data, self.compression)
+
+    def write_chunks(self, name, chunks):
+        """
+        Write the record from an iterable of byte strings, without holding it in memory
+        """
+        with atomic_write(os.path.join(self.directory, name), self.compression) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return os.path.join(self.directory, name) + EXTENSIONS[self.compression]
+
+    def read(self, name):
+        path = self.path(name)
+        if path is None:
+            raise KeyError(name)
+        with open_file(path) as f:
+            return f.read()
+
+    def open(self, name):
+        path = self.path(name)
+        if path is None:
+            raise KeyError(name)
+        return open_file(path)
+
+
+class PackStore(object):
+    """
+    Records packed in one <year>.pack file per year (the first four characters of the record names, which
+    start with a date), with next to it a <year>.idx file holding a JSON line {name, offset, length,
+    compression} per record. Records are only ever appended; a later record with the same name replaces
+    the earlier one, until compact drops the replaced ones. The index line is written after the data, so an
+    interrupted write is simply absent. Writers hold a lock on <year>.lock, so several threads and processes
+    can write to the same pack (on Windows, only the threads of one process).
+    """
+
+    def __init__(self, directory, compression=None):
+        self.directory = directory
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.indexes = {}
+        # Year -> (inode, size) of the index file when it was read, to notice writes by other processes
+        self.loaded = {}
+
+    @staticmethod
+    def present(directory):
+        return len(glob.glob(os.path.join(directory, '*.idx'))) > 0
+
+    def _files(self, year):
+        return os.path.join(self.directory, year + '.pack'), os.path.join(self.directory, year + '.idx')
+
+    @contextmanager
+    def _locked(self, year):
+        """
+        Hold the lock of the pack of year, against other threads and other processes
+        """
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.directory, year + '.lock'), 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _recover(self, year):
+        """
+        Finish or undo a compaction of year that was interrupted, see compact
+        """
+        pack_path, index_path = self._files(year)
+        if os.path.exists(pack_path + '.part'):
+            # Interrupted before the new pack was in place: the old pack and index are intact
+            os.remove(pack_path + '.part')
+            if os.path.exists(index_path + '.part'):
+                os.remove(index_path + '.part')
+        elif os.path.exists(index_path + '.part'):
+            # The new pack is in place, and its complete index is waiting next to it
+            os.rename(index_path + '.part', index_path)
+
+    def _load(self, year):
+        index = {}
+        _, index_path = self._files(year)
+        info = None
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                info = os.fstat(f.fileno())
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Cut off by an interrupted write
+                        continue
+                    index[entry['name']] = entry
+        self.indexes[year] = index
+        self.loaded[year] = (info.st_ino, info.st_size) if info else None
+
+    def _refresh(self, year):
+        """
+        Read the index of year again when another process wrote to it; call with the lock held
+        """
+        _, index_path = self._files(year)
+        info = os.stat(index_path) if os.path.exists(index_path) else None
+        if year not in self.indexes or self.loaded.get(year) != ((info.st_ino, info.st_size) if info else None):
+            self._load(year)
+
+    def index(self, year):
+        """
+        Dict of name -> index entry of the records of year
+        """
+        if year not in self.indexes:
+            if os.path.exists(os.path.join(self.directory, year + '.idx.part')):
+                with self._locked(year):
+                    self._recover(year)
+            self._load(year)
+        return self.indexes[year]
+
+    def years(self):
+        return sorted(os.path.basename(path)[:-len('.idx')] for path in glob.glob(os.path.join(self.directory, '*.idx')))
+
+    def names(self, year=None):
+        if year is not None:
+            return list(self.index(year).keys())
+        names = []
+        for year in self.years():
+            names.extend(self.index(year).keys())
+        return names
+
+    def find(self, date=None, activity_id=None):
+        """
+        Names of the records of date (yyyy-mm-dd) and/or of activity activity_id (named <date>_<id>.txt)
+        """
+        years = [date[:4]] if date else self.years()
+        found = []
+        for year in years:
+            for name in self.index(year):
+                if date and not name.startswith(date + '_'):
+                    continue
+                if activity_id is not None and name[11:].split('.')[0] != str(activity_id):
+                    continue
+                found.append(name)
+        return sorted(found)
+
+    def __contains__(self, name):
+        return name in self.index(name[:4])
+
+    def stamp(self, name):
+        """
+        What changes when record name is written again: where it is in the pack
+        """
+        entry = self.index(name[:4])[name]
+        return [entry['offset'], entry['length']]
+
+    def write(self, name, data):
+        data = compress(data, self.compression)
+        year = name[:4]
+        pack_path, index_path = self._files(year)
+        with self._locked(year):
+            self._recover(year)
+            self._refresh(year)
+            with open(pack_path, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            entry = {'name': name, 'offset': offset, 'length': len(data), 'compression': self.compression}
+            with open(index_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+                info = os.fstat(f.fileno())
+            self.indexes[year][name] = entry
+            self.loaded[year] = (info.st_ino, info.st_size)
+        return '{}#{}'.format(pack_path, name)
+
+    def write_chunks(self, name, chunks):
+        return self.write(name, b''.join(chunks))
+
+    def read(self, name):
+        entry = self.index(name[:4]).get(name)
+        if entry is None:
+            raise KeyError(name)
+        pack_path, _ = self._files(name[:4])
+        with open(pack_path, 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['length'])
+        return decompress(data, entry['compression'])
+
+    def open(self, name):
+        return io.BytesIO(self.read(name))
+
+    def garbage(self, year):
+        """
+        Number of bytes in the pack of year taken by records that were replaced since
+        """
+        pack_path, _ = self._files(year)
+        if not os.path.exists(pack_path):
+            return 0
+        return os.path.getsize(pack_path) - sum(entry['length'] for entry in self.index(year).values())
+
+    def compact(self, years=None, min_garbage=0.0):
+        """
+        Rewrite the packs of years (by default all) with only their current records, dropping the copies that
+        were replaced, when at least min_garbage (a fraction) of the pack is taken by those. The new pack and
+        index are written next to the old ones and then renamed into place; an interrupted compaction is
+        finished or undone by the next reader or writer. Other scripts should not read the folder meanwhile.
+        Returns the number of bytes reclaimed.
+        """
+        reclaimed = 0
+        for year in years or self.years():
+            pack_path, index_path = self._files(year)
+            with self._locked(year):
+                self._recover(year)
+                self._refresh(year)
+                size = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+                garbage = self.garbage(year)
+                if not garbage or garbage < min_garbage * size:
+                    continue
+                entries = sorted(self.indexes[year].values(), key=lambda entry: entry['offset'])
+                index = {}
+                with open(pack_path, 'rb') as source:
+                    with open(pack_path + '.part', 'wb') as target:
+                        for entry in entries:
+                            source.seek(entry['offset'])
+                            data = source.read(entry['length'])
+                            index[entry['name']] = dict(entry, offset=target.tell())
+                            target.write(data)
+                        target.flush()
+                        os.fsync(target.fileno())
+                with open(index_path + '.part', 'w') as f:
+                    for entry in entries:
+                        f.write(json.dumps(index[entry['name']]) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(pack_path + '.part', pack_path)
+                os.rename(index_path + '.part', index_path)
+                self._load(year)
+                reclaimed += garbage
+        return reclaimed
+
+
+def names_by_day(store, suffix='.json'):
+    """
+    Dict of date -> names of the records of that day in store, named <yyyy-mm-dd>_<kind><suffix>
+    """
+    pattern = re.compile(r'^(\d{4}-\d{2}-\d{2})_\w+' + re.escape(suffix) + '$')
+    days = {}
+    for name in store.names():
+        match = pattern.match(name)
+        if match:
+            days.setdefault(match.group(1), []).append(name)
+    return days
+
+
+def stamps_digest(store, names):
+    """
+    Hash of what the records names in store were when they were last written, see DirectoryStore.stamp; it changes
+    when any of them is written again
+    """
+    stamps = [[name, store.stamp(name)] for name in sorted(names)]
+    return hashlib.sha1(json.dumps(stamps).encode('utf-8')).hexdigest()
+
+
+def activity_id(name):
+    """
+    Id of the activity in the name of a record or file (possibly compressed) as download.py names them, or None
+    """
+    match = ACTIVITY_RE.match(strip_compression(os.path.basename(name)))
+    return match.group(2) if match else None
+
+
+def read_manifest(directory):
+    """
+    Dict of activity id -> entry (the last one) of the manifest download.py keeps in directory; empty without one
+    """
+    manifest = {}
+    path = os.path.join(directory, 'manifest.jsonl')
+    if not os.path.exists(path):
+        return manifest
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            manifest[str(entry['activityId'])] = entry
+    return manifest
+
+
+def manifest_sports(directory):
+    """
+    Dict of activity id -> sport of the activities in the manifest download.py keeps in directory, as far as it
+    recorded their sport; empty without a manifest
+    """
+    return dict((activity_id, entry['sport']) for activity_id, entry in read_manifest(directory).items()
+                if 'sport' in entry)
+
+
+def activity_files(directory, sport=None):
+    """
+    The activities in directory, sorted: the record names when they are packed (see PackStore), the paths of
+    the files otherwise. Those are the files download.py writes, plus any .tcx files. With sport, activities
+    that the manifest records as another sport are left out, without opening them.
+    """
+    if PackStore.present(directory):
+        names = [name for name in PackStore(directory).names() if activity_id(name) is not None]
+    else:
+        names = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and (strip_compression(name).endswith('.tcx') or activity_id(name) is not None):
+                names.append(path)
+    if sport is not None:
+        sports = manifest_sports(directory)
+        names = [name for name in names if sports.get(activity_id(name), sport) == sport]
+    return sorted(names)
+
+
+def open_store(directory, compression=None):
+    """
+    PackStore if directory holds packed records, DirectoryStore otherwise
+    """
+    if PackStore.present(directory):
+        return PackStore(directory, compression)
+    return DirectoryStore(directory, compression)
+
+
+def run_compact():
+    parser = argparse.ArgumentParser(description='Reclaim the space taken in the packs of a folder by records that '
+                                                 'were written again')
+    parser.add_argument('-d', '--directory', required=True, help='Folder holding <year>.pack files')
+    args = vars(parser.parse_args())
+    reclaimed = PackStore(args['directory']).compact()
+    print('Reclaimed {:.1f} MB'.format(reclaimed / 1024.0 / 1024.0))
+
+
+if __name__ == '__main__':
+    run_compact()
@@ -0,0 +1,282 @@
+"""
+Dataset of activity summaries, as listed by the Garmin Connect activity list: one row per activity with its
+distance, duration, calories, heart rate and so on. download.py appends to it while downloading, so whole-history
+statistics do not need any of the TCX files to be parsed.
+
+The dataset is activities.csv in the Historical folder: a header naming the SUMMARY_FIELDS, then one line per
+activity, only ever appended to. Empty values are missing in the activity list. load_summaries reads it into
+one NumPy array per column.
+
+    python summaries.py -d ~/garmin/username/Historical
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+
+import storage
+
+try:
+    # Only needed to load the dataset
+    import numpy as np
+except ImportError:
+    np = None
+
+SUMMARIES = 'activities.csv'
+# Totals per week, month and year, next to the dataset, see update_rollups
+ROLLUPS = 'rollups.json'
+PERIODS = ['week', 'month', 'year']
+# Totals kept per period; caloriesDistance is the distance of the activities that have a calorie count
+ROLLUP_TOTALS = ['count', 'distance', 'duration', 'calories', 'caloriesDistance']
+
+# Column -> type; the activity list calls it the same, except for sport and typeKey (see download.tcx_sport).
+# distance is in meters, duration in seconds, averageSpeed in m/s.
+SUMMARY_FIELDS = [('activityId', 'int'),
+                  ('startTimeLocal', 'datetime'),
+                  ('sport', 'str'),
+                  ('typeKey', 'str'),
+                  ('distance', 'float'),
+                  ('duration', 'float'),
+                  ('movingDuration', 'float'),
+                  ('elevationGain', 'float'),
+                  ('averageSpeed', 'float'),
+                  ('averageHR', 'float'),
+                  ('maxHR', 'float'),
+                  ('calories', 'float')]
+
+
+def summary_row(item, sport):
+    """
+    Row of the dataset for an item of the activity list
+    """
+    row = []
+    for field, kind in SUMMARY_FIELDS:
+        if field == 'sport':
+            value = sport
+        elif field == 'typeKey':
+            value = (item.get('activityType') or {}).get('typeKey')
+        else:
+            value = item.get(field)
+        row.append('' if value is None else str(value))
+    return row
+
+
+def open_csv(file_path, mode):
+    if sys.version_info[0] < 3:
+        return open(file_path, mode + 'b')
+    return io.open(file_path, mode, newline='', encoding='utf-8')
+
+
+def known_activities(folder):
+    """
+    Set of the ids (as strings) of the activities already in the dataset of folder
+    """
+    file_path = os.path.join(folder, SUMMARIES)
+    if not os.path.exists(file_path):
+        return set()
+    with open_csv(file_path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return set(row[0] for row in reader if row)
+
+
+def missing_summaries(folder):
+    """
+    Ids of the activities in the manifest download.py keeps in folder that are not in the dataset yet: those
+    downloaded before it was kept. The next download.py run adds them.
+    """
+    return set(storage.read_manifest(folder)) - known_activities(folder)
+
+
+def add_summaries(folder, known, rows):
+    """
+    Append the rows of activities not in known (a set of ids, updated) to the dataset of folder
+    """
+    rows = [row for row in rows if row[0] not in known]
+    if not rows:
+        return
+    file_path = os.path.join(folder, SUMMARIES)
+    is_new = not os.path.exists(file_path)
+    if not is_new:
+        with open(file_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            cut_off = f.read(1) != b'\n'
+    with open_csv(file_path, 'a') as f:
+        writer = csv.writer(f)
+        if is_new:
+            writer.writerow([field for field, _ in SUMMARY_FIELDS])
+        elif cut_off:
+            # End the line an interrupted run left unfinished, so it does not run into the new rows
+            f.write(u'\n')
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    known.update(row[0] for row in rows)
+
+
+def read_rows(folder, offset=0):
+    """
+    Rows of the dataset of folder from byte offset on (0 being the start of the data, after the header), and
+    the offset following the last complete line, to continue reading from when more rows have been appended.
+    A folder without a dataset (downloaded before it was kept) has no rows.
+    """
+    file_path = os.path.join(folder, SUMMARIES)
+    if not os.path.exists(file_path):
+        return [], 0
+    with open(file_path, 'rb') as f:
+        if offset == 0:
+            f.readline()
+        else:
+            f.seek(offset)
+        start = f.tell()
+        data = f.read()
+    # A line cut off by an interrupted run is left for the next time
+    complete = data.rfind(b'\n') + 1
+    lines = data[:complete].splitlines(True)
+    if sys.version_info[0] >= 3:
+        lines = [line.decode('utf-8') for line in lines]
+    rows = [row for row in csv.reader(lines) if len(row) == len(SUMMARY_FIELDS)]
+    return rows, start + complete
+
+
+def to_columns(rows):
+    """
+    Dict of column -> array of rows of the dataset, sorted by start time. Missing numbers are NaN;
+    startTimeLocal is a datetime64[s] array.
+    """
+    if np is None:
+        raise ImportError('Loading the activity summaries needs numpy')
+    columns = list(zip(*rows)) if rows else [()] * len(SUMMARY_FIELDS)
+    summaries = {}
+    for (field, kind), values in zip(SUMMARY_FIELDS, columns):
+        if kind == 'int':
+            summaries[field] = np.array(values, dtype=np.int64)
+        elif kind == 'float':
+            summaries[field] = np.array([value or 'nan' for value in values], dtype=np.float64)
+        elif kind == 'datetime':
+            summaries[field] = np.array([value.replace(' ', 'T') for value in values], dtype='datetime64[s]')
+        else:
+            summaries[field] = np.array(values, dtype=str)
+    order = np.argsort(summaries['startTimeLocal'], kind='mergesort')
+    return dict((field, values[order]) for field, values in summaries.items())
+
+
+def load_summaries(folder):
+    """
+    Read the dataset of folder into a dict of column -> array, see to_columns
+    """
+    rows, _ = read_rows(folder)
+    # The last row of an activity wins
+    return to_columns(list(dict((row[0], row) for row in rows).values()))
+
+
+def period_starts(times, period):
+    """
+    First day of the week (starting on Monday), month or year of each of the datetime64 times
+    """
+    if period == 'week':
+        days = times.astype('datetime64[D]')
+        # Day 0, 1970-01-01, was a Thursday
+        return days - (days.astype(np.int64) + 3) % 7
+    elif period == 'month':
+        return times.astype('datetime64[M]').astype('datetime64[D]')
+    return times.astype('datetime64[Y]').astype('datetime64[D]')
+
+
+def rollup(summaries, period):
+    """
+    Totals per period ('week', 'month' or 'year') of summaries (see to_columns): a dict of the first day of each
+    period (yyyy-mm-dd) -> {name: total} for the ROLLUP_TOTALS
+    """
+    unique, index = np.unique(period_starts(summaries['startTimeLocal'], period), return_inverse=True)
+    distance = np.nan_to_num(summaries['distance'])
+    calories = summaries['calories']
+    weights = {'distance': distance,
+               'duration': np.nan_to_num(summaries['duration']),
+               'calories': np.nan_to_num(calories),
+               'caloriesDistance': np.where(np.isnan(calories), 0, distance)}
+    totals = {'count': np.bincount(index, minlength=len(unique))}
+    for name, values in weights.items():
+        totals[name] = np.bincount(index, weights=values, minlength=len(unique))
+    return dict((str(start), dict((name, float(totals[name][i])) for name in ROLLUP_TOTALS))
+                for i, start in enumerate(unique))
+
+
+def update_rollups(folder, sport=None):
+    """
+    Totals per week, month and year of the activities (of sport, or all) in the dataset of folder, as
+    {'week': rollup, 'month': rollup, 'year': rollup}. They are kept in ROLLUPS with the offset in the dataset
+    up to which they were counted, so only activities appended since are read and added.
+    """
+    file_path = os.path.join(folder, ROLLUPS)
+    dataset = os.path.join(folder, SUMMARIES)
+    state = None
+    if os.path.exists(file_path):
+        with open(file_path, 'r') as f:
+            state = json.load(f)
+        size = os.path.getsize(dataset) if os.path.exists(dataset) else 0
+        if state.get('sport') != sport or state['offset'] > size:
+            state = None
+    if state is None:
+        state = {'sport': sport, 'offset': 0, 'week': {}, 'month': {}, 'year': {}}
+
+    rows, offset = read_rows(folder, state['offset'])
+    if sport is not None:
+        rows = [row for row in rows if row[2] == sport]
+    if rows:
+        summaries = to_columns(rows)
+        for period in PERIODS:
+            for start, totals in rollup(summaries, period).items():
+                known = state[period].setdefault(start, dict((name, 0.0) for name in ROLLUP_TOTALS))
+                for name in ROLLUP_TOTALS:
+                    known[name] += totals[name]
+    if offset != state['offset']:
+        state['offset'] = offset
+        with open(file_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(file_path + '.tmp', file_path)
+    return state
+
+
+def estimated_calories(totals):
+    """
+    Calories of a rollup period, estimating those of activities without a calorie count from the calories per
+    meter of the others
+    """
+    if not totals['caloriesDistance']:
+        return totals['calories']
+    return totals['calories'] * totals['distance'] / totals['caloriesDistance']
+
+
+def print_overview(summaries):
+    sports, index = np.unique(summaries['sport'], return_inverse=True)
+    distances = np.bincount(index, weights=np.nan_to_num(summaries['distance']), minlength=len(sports))
+    durations = np.bincount(index, weights=np.nan_to_num(summaries['duration']), minlength=len(sports))
+    counts = np.bincount(index, minlength=len(sports))
+    print('{:<10} {:>8} {:>12} {:>10} {:>14}'.format('sport', 'count', 'distance km', 'hours', 'pace min/km'))
+    for sport, count, distance, duration in zip(sports, counts, distances, durations):
+        pace = duration / 60.0 / (distance / 1000.0) if distance else float('nan')
+        print('{:<10} {:>8d} {:>12.1f} {:>10.1f} {:>14.2f}'.format(sport or '?', count, distance / 1000.0,
+                                                                   duration / 3600.0, pace))
+    print()
+    print('{:<10} {:>8} {:>12}'.format('month', 'count', 'distance km'))
+    months = rollup(summaries, 'month')
+    for month in sorted(months):
+        print('{:<10} {:>8d} {:>12.1f}'.format(month[:7], int(months[month]['count']),
+                                               months[month]['distance'] / 1000.0))
+
+
+def run_summaries():
+    parser = argparse.ArgumentParser(description='Statistics over the whole activity history, from the summaries '
+                                                 'download.py keeps')
+    parser.add_argument('-d', '--directory', required=True, help='Historical folder of a user')
+    args = vars(parser.parse_args())
+    print_overview(load_summaries(args['directory']))
+
+
+if __name__ == '__main__':
+    run_summaries()
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import columnar
+
+
+def write_day(folder, date, heartrate, extra=0):
+    """
+    Wellness files of date with the heart rate values heartrate, one minute apart
+    """
+    start = 1546300800000 + 86400000 * int(date[-2:])
+    files = {'heartrate': {'heartRateValues': [[start + 60000 * i, value] for i, value in enumerate(heartrate)]},
+             'stress': {'stressValuesArray': [[start, 20 + extra]]},
+             'summary': [{'startGMT': date + 'T08:00:00.0', 'steps': 100 + extra,
+                          'primaryActivityLevel': 'active'}],
+             'wellness': {'allMetrics': {'metricsMap': {'WELLNESS_TOTAL_STEPS': [{'value': 100 + extra}]}}},
+             'sleep': {'dailySleepDTO': {'sleepStartTimestampGMT': start, 'sleepEndTimestampGMT': start + 1000}}}
+    for kind, data in files.items():
+        with open(os.path.join(folder, '{}_{}.json'.format(date, kind)), 'w') as f:
+            json.dump(data, f)
+
+
+@pytest.fixture
+def folder(tmpdir):
+    folder = str(tmpdir)
+    write_day(folder, '2019-01-01', [60, None, 62])
+    write_day(folder, '2019-01-02', [70])
+    write_day(folder, '2019-01-03', [80, 81])
+    return folder
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """
+    Dates read_day parsed, in order
+    """
+    dates = []
+    read_day = columnar.read_day
+
+    def counting(store, date, names):
+        dates.append(date)
+        return read_day(store, date, names)
+    monkeypatch.setattr(columnar, 'read_day', counting)
+    return dates
+
+
+def test_load_before_ingest(folder):
+    assert columnar.load(folder) is None
+
+
+def test_ingest_round_trip(folder):
+    columns = columnar.ingest(folder)
+    assert columns.days == ['2019-01-01', '2019-01-02', '2019-01-03']
+    heartrate = columns.series('heartrate', '2019-01-01')
+    assert list(heartrate['value'][[0, 2]]) == [60, 62]
+    assert np.isnan(heartrate['value'][1])
+    assert list(columns.series('heartrate', '2019-01-03')['value']) == [80, 81]
+    steps = columns.series('steps', '2019-01-02')
+    assert list(steps['value']) == [100]
+    assert list(steps['level']) == [columnar.ACTIVITY_LEVELS['active']]
+    assert columns.metrics('2019-01-02') == {'WELLNESS_TOTAL_STEPS': [{'value': 100}]}
+    assert columns.sleep('2019-01-02')[1] - columns.sleep('2019-01-02')[0] == 1000
+    assert columns.series('heartrate', '2019-01-04') is None
+
+    loaded = columnar.load(folder)
+    assert loaded.days == columns.days
+    assert list(loaded.series('stress', '2019-01-03')['value']) == [20]
+
+
+def test_ingest_ignores_other_json_files(folder):
+    for name in ['build.json', 'notes_2019.json', '2019-01-04.json']:
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write('{}')
+    assert columnar.ingest(folder).days == ['2019-01-01', '2019-01-02', '2019-01-03']
+
+
+def test_ingest_reuses_unchanged_days(folder, reads):
+    columnar.ingest(folder)
+    assert reads == ['2019-01-01', '2019-01-02', '2019-01-03']
+
+    del reads[:]
+    assert columnar.ingest(folder).index['generation'] == 1
+    assert reads == []
+
+    write_day(folder, '2019-01-02', [71, 72, 73], extra=5)
+    write_day(folder, '2019-01-04', [90])
+    columns = columnar.ingest(folder)
+    assert reads == ['2019-01-02', '2019-01-04']
+    assert columns.days == ['2019-01-01', '2019-01-02', '2019-01-03', '2019-01-04']
+    assert list(columns.series('heartrate', '2019-01-02')['value']) == [71, 72, 73]
+    # The days around the changed one are copied from the old arrays unchanged
+    assert list(columns.series('heartrate', '2019-01-03')['value']) == [80, 81]
+    assert list(columns.series('stress', '2019-01-01')['value']) == [20]
+    assert columns.metrics('2019-01-01') == {'WELLNESS_TOTAL_STEPS': [{'value': 100}]}
+
+
+def test_ingest_swaps_generations(folder):
+    columnar.ingest(folder)
+    store = os.path.join(folder, columnar.COLUMNAR)
+    first = sorted(os.listdir(store))
+    assert all(name.endswith('.1.npy') for name in first if name != columnar.INDEX)
+
+    write_day(folder, '2019-01-01', [65], extra=1)
+    columns = columnar.ingest(folder)
+    assert columns.index['generation'] == 2
+    second = sorted(os.listdir(store))
+    assert second == sorted(name.replace('.1.npy', '.2.npy') for name in first)
+    assert list(columns.series('heartrate', '2019-01-01')['value']) == [65]
+
+
+def test_ingest_only_dates(folder, reads):
+    columns = columnar.ingest(folder, ['2019-01-02'])
+    assert reads == ['2019-01-02']
+    assert columns.days == ['2019-01-02']
+
+    del reads[:]
+    write_day(folder, '2019-01-01', [66], extra=1)
+    write_day(folder, '2019-01-03', [86], extra=1)
+    columns = columnar.ingest(folder, ['2019-01-01', '2019-01-05'])
+    # 2019-01-03 changed too, but was not asked for; 2019-01-05 has no files
+    assert reads == ['2019-01-01']
+    assert columns.days == ['2019-01-01', '2019-01-02']
+    assert list(columns.series('heartrate', '2019-01-01')['value']) == [66]
+    assert list(columns.series('heartrate', '2019-01-02')['value']) == [70]
@@ -0,0 +1,280 @@
+import json
+import logging
+import os
+import re
+
+import pytest
+
+pytest.importorskip('mechanize')
+
+import download
+import storage
+import summaries
+
+
+class FakeTransport(object):
+    """
+    Serves the pages of the activity list and the TCX files of activities, failing for the ids in broken
+    """
+
+    def __init__(self, items, broken=()):
+        self.items = items
+        self.broken = set(broken)
+        self.requested = []
+
+    def for_thread(self):
+        return self
+
+    def get(self, url):
+        self.requested.append(url)
+        start, limit = [int(value) for value in re.search(r'start=(\d+)&limit=(\d+)', url).groups()]
+        return json.dumps(self.items[start:start + limit]).encode('utf-8')
+
+    def chunks(self, url):
+        activity_id = url.rsplit('/', 1)[1]
+        if activity_id in self.broken:
+            raise IOError('Connection reset for {}'.format(activity_id))
+        yield b'<tcx id="' + activity_id.encode('utf-8') + b'"/>'
+
+
+def items(count):
+    """
+    Activity list of count activities, newest first like Garmin Connect
+    """
+    return [{'activityId': number, 'startTimeLocal': '2019-01-{:02d} 10:00:00'.format(number),
+             'activityType': {'typeId': 1, 'typeKey': 'running', 'parentTypeId': 17}, 'distance': 1000.0 * number}
+            for number in range(count, 0, -1)]
+
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('test')
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download, 'BACKOFF', 0)
+
+
+def run(logger, folder, transport, **options):
+    options.setdefault('increment', 2)
+    return download.activities(logger, transport, 'user', folder, retries=0, **options)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_failed_activity_keeps_checkpoint_and_sync_state(tmpdir, logger, workers):
+    folder = str(tmpdir)
+    failed = run(logger, folder, FakeTransport(items(5), broken=['2']), workers=workers)
+
+    assert failed == [(2, '2019-01-02', 'Running')]
+    assert sorted(download.load_manifest(logger, folder)) == ['1', '3', '4', '5']
+    assert not os.path.exists(os.path.join(folder, download.SYNCSTATE))
+    # Activity 2 is on the third page (5, 4 | 3, 2 | 1), where the next run resumes
+    checkpoint = download.Checkpoint(os.path.join(folder, download.CHECKPOINT))
+    assert checkpoint.get('start') == 2
+
+    transport = FakeTransport(items(5))
+    assert run(logger, folder, transport, workers=workers) == []
+    assert 'start=2&' in transport.requested[0]
+    assert sorted(download.load_manifest(logger, folder)) == ['1', '2', '3', '4', '5']
+    assert download.load_sync_state(folder) == {'activityId': '5', 'startTimeLocal': '2019-01-05 10:00:00',
+                                                'summaries': True}
+    assert not os.path.exists(os.path.join(folder, download.CHECKPOINT))
+
+
+def test_checkpoint_of_other_options_is_ignored(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(5), broken=['2']))
+
+    # An incremental run does not resume the backfill checkpoint, and starts at the newest activity
+    transport = FakeTransport(items(6))
+    assert run(logger, folder, transport, incremental=True) == []
+    assert 'start=0&' in transport.requested[0]
+
+
+def test_activities_are_stored_and_recorded(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(3)), store=storage.PackStore(folder))
+
+    manifest = download.load_manifest(logger, folder)
+    assert manifest['3']['file'] == '2019-01-03_3.txt'
+    assert manifest['3']['sport'] == 'Running'
+    assert storage.PackStore(folder).read('2019-01-03_3.txt') == b'<tcx id="3"/>'
+    assert summaries.known_activities(folder) == set(['1', '2', '3'])
+
+
+@pytest.mark.parametrize('activity_type, sport', [
+    ({'typeId': 1, 'typeKey': 'running', 'parentTypeId': 17}, 'Running'),
+    ({'typeId': 18, 'typeKey': 'treadmill_running', 'parentTypeId': 1}, 'Running'),
+    ({'typeId': 153, 'typeKey': 'virtual_run', 'parentTypeId': 1}, 'Running'),
+    ({'typeId': 10, 'typeKey': 'road_biking', 'parentTypeId': 2}, 'Biking'),
+    ({'typeId': 152, 'typeKey': 'virtual_ride', 'parentTypeId': 2}, 'Biking'),
+    ({'typeId': 26, 'typeKey': 'lap_swimming', 'parentTypeId': 27}, None),
+    ({'typeKey': 'ultra_run'}, None),
+    (None, None)])
+def test_tcx_sport_only_when_certain(activity_type, sport):
+    assert download.tcx_sport({'activityType': activity_type}) == sport
+
+
+def test_uncertain_sport_is_not_recorded(tmpdir, logger):
+    folder = str(tmpdir)
+    listed = items(3)
+    listed[0]['activityType'] = {'typeId': 153, 'typeKey': 'virtual_run', 'parentTypeId': 1}
+    listed[1]['activityType'] = {'typeKey': 'obstacle_run'}
+    run(logger, folder, FakeTransport(listed))
+    # Recorded as another sport by an earlier guess
+    entry = dict(download.load_manifest(logger, folder)['2'], sport='Other')
+    download.add_to_manifest({}, folder, entry)
+
+    run(logger, folder, FakeTransport(listed))
+    manifest = download.load_manifest(logger, folder)
+    assert manifest['3']['sport'] == 'Running'
+    assert 'sport' not in manifest['2']
+    assert [os.path.basename(path) for path in storage.activity_files(folder, 'Running')] == \
+        ['2019-01-01_1.txt', '2019-01-02_2.txt', '2019-01-03_3.txt']
+
+
+def test_incremental_run_backfills_summaries(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(6)))
+    # An archive from before the summaries were kept
+    os.remove(os.path.join(folder, summaries.SUMMARIES))
+    state = download.load_sync_state(folder)
+    del state['summaries']
+    download.save_sync_state(folder, state)
+    assert summaries.missing_summaries(folder) == set(['1', '2', '3', '4', '5', '6'])
+
+    transport = FakeTransport(items(7))
+    assert run(logger, folder, transport, incremental=True) == []
+    # Pages on (7, 6 | 5, 4 | 3, 2 | 1) until all have a summary, instead of stopping at the second page
+    assert len(transport.requested) == 4
+    assert summaries.missing_summaries(folder) == set()
+    assert download.load_sync_state(folder)['summaries']
+
+    transport = FakeTransport(items(8))
+    run(logger, folder, transport, incremental=True)
+    assert len(transport.requested) == 2
+
+
+def test_sync_after_empty_activity_list(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport([]), incremental=True)
+    # No activities yet, so there is no high-water mark, only the note that no summaries are missing
+    assert download.load_sync_state(folder) == {'summaries': True}
+
+    assert run(logger, folder, FakeTransport(items(3)), incremental=True) == []
+    assert sorted(download.load_manifest(logger, folder)) == ['1', '2', '3']
+    state = download.load_sync_state(folder)
+    assert state['activityId'] == '3'
+    assert state['startTimeLocal'] == '2019-01-03 10:00:00'
+
+
+def test_backfill_happens_once(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(6)), incremental=True)
+    # Activity 3 was deleted on Garmin Connect after it was downloaded, so it never gets a summary
+    with open(os.path.join(folder, download.MANIFEST), 'a') as f:
+        f.write(json.dumps(download.manifest_entry('2018-12-31_99.txt', 99, '2018-12-31', 1, 'x')) + '\n')
+    transport = FakeTransport(items(7))
+    run(logger, folder, transport, incremental=True)
+    assert len(transport.requested) == 2
+    assert summaries.missing_summaries(folder) == set(['99'])
+
+
+def test_manifest_after_cut_off_line(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(2)))
+    # An interrupted run left half an entry behind
+    with open(os.path.join(folder, download.MANIFEST), 'a') as f:
+        f.write('{"activityId": "9", "da')
+
+    manifest = download.load_manifest(logger, folder)
+    assert sorted(manifest) == ['1', '2']
+    download.add_to_manifest(manifest, folder, download.manifest_entry('2019-01-03_3.txt', 3, '2019-01-03', 1, 'x'))
+    assert sorted(download.load_manifest(logger, folder)) == ['1', '2', '3']
+
+
+def test_manifest_is_rebuilt_from_files(tmpdir, logger):
+    folder = str(tmpdir)
+    run(logger, folder, FakeTransport(items(2)))
+    packed = os.path.join(folder, 'packed')
+    os.makedirs(packed)
+    run(logger, packed, FakeTransport(items(3)), store=storage.PackStore(packed))
+    expected = download.load_manifest(logger, folder)
+    os.remove(os.path.join(folder, download.MANIFEST))
+
+    manifest = download.load_manifest(logger, folder)
+    assert sorted(manifest) == ['1', '2']
+    assert manifest['2']['sha1'] == expected['2']['sha1']
+    os.remove(os.path.join(packed, download.MANIFEST))
+    assert sorted(download.load_manifest(logger, packed)) == ['1', '2', '3']
+
+
+def test_sync_state_round_trip(tmpdir):
+    folder = str(tmpdir)
+    assert download.load_sync_state(folder) == {}
+    download.save_sync_state(folder, {'activityId': '3', 'startTimeLocal': '2019-01-03 10:00:00'})
+    assert download.load_sync_state(folder)['activityId'] == '3'
+    with open(os.path.join(folder, download.SYNCSTATE), 'w') as f:
+        f.write('{"activityId": ')
+    assert download.load_sync_state(folder) == {}
+
+
+def test_read_batch_file(tmpdir):
+    file_path = str(tmpdir.join('accounts.csv'))
+    with open(file_path, 'w') as f:
+        f.write('# username,password,displayname\n'
+                'runner@example.com,secret\n'
+                '\n'
+                'cyclist@example.com,"pass,word",abc-123\n'
+                'walker@example.com,"say ""hi"""\n')
+    assert download.read_batch_file(file_path) == [('runner@example.com', 'secret', None),
+                                                   ('cyclist@example.com', 'pass,word', 'abc-123'),
+                                                   ('walker@example.com', 'say "hi"', None)]
+
+    with open(file_path, 'a') as f:
+        f.write('swimmer@example.com\n')
+    with pytest.raises(ValueError):
+        download.read_batch_file(file_path)
+
+
+def test_batch_counts_failed_downloads(logger, monkeypatch):
+    def download_for_account(logger, username, password, display_name, args):
+        if username == 'broken':
+            raise download.LoginError('Login failed')
+        return [(2, '2019-01-02', 'Running')] if username == 'partial' else []
+
+    monkeypatch.setattr(download, 'download_for_account', download_for_account)
+    results = download.run_batch(logger, [('ok', 'pw', None), ('partial', 'pw', None), ('broken', 'pw', None)],
+                                 {'displayname': None}, workers=2)
+    errors = dict((username, error) for username, error, _ in results)
+    assert errors == {'ok': None, 'partial': '1 downloads failed', 'broken': 'Login failed'}
+
+
+@pytest.mark.parametrize('workers, interval, expected', [(1, None, 0), (4, None, download.PARALLEL_INTERVAL),
+                                                         (1, 0.5, 0.5), (4, 0, 0)])
+def test_interval_only_throttles_parallel_downloads(logger, monkeypatch, workers, interval, expected):
+    used = []
+    monkeypatch.setattr(download, 'login_user', lambda *args, **kwargs: None)
+    monkeypatch.setattr(download, 'download_files_for_user',
+                        lambda *args, **kwargs: used.append(kwargs['interval']) or [])
+    args = {'output': '.', 'no_session': True, 'session_dir': None, 'startdate': None, 'incremental': False,
+            'since': None, 'workers': workers, 'interval': interval, 'retries': 0, 'compress': None, 'pack': False}
+    download.download_for_account(logger, 'user', 'pw', None, args)
+    assert used == [expected]
+
+
+@pytest.mark.parametrize('error', [download.me.URLError('Name or service not known'), IOError('Connection reset'),
+                                   download.RateLimited('https://connect.garmin.com/', 60)])
+def test_failed_first_page_exits_with_error(tmpdir, logger, monkeypatch, error):
+    credentials = tmpdir.join('login.csv')
+    credentials.write('user,password')
+
+    def download_for_account(logger, username, password, display_name, args):
+        raise error
+    monkeypatch.setattr(download, 'download_for_account', download_for_account)
+    monkeypatch.setattr(download, 'get_logger', lambda: logger)
+    monkeypatch.setattr(download.sys, 'argv', ['download.py', '-c', str(credentials), '-o', str(tmpdir)])
+    with pytest.raises(SystemExit) as exit:
+        download.run_download()
+    assert exit.value.code not in (None, 0)
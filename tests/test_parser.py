@@ -0,0 +1,281 @@
+import io
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+# parser.py is Python 2 code that needs matplotlib and scipy; elsewhere `parser` may be another module entirely
+try:
+    import parser as gcparser
+except (ImportError, SyntaxError):
+    gcparser = None
+if not hasattr(gcparser, 'GCFileParser'):
+    pytest.skip('parser.py needs Python 2, matplotlib and scipy', allow_module_level=True)
+
+import storage
+
+
+def tcx(start, laps, sport='Running'):
+    """
+    TCX file of an activity of sport started at start, with laps of (distance, seconds)
+    """
+    return ('<?xml version="1.0"?><TrainingCenterDatabase><Activities><Activity Sport="{}"><Id>{}</Id>{}</Activity>'
+            '</Activities></TrainingCenterDatabase>').format(sport, start, ''.join(
+                '<Lap StartTime="{}"><TotalTimeSeconds>{}</TotalTimeSeconds><DistanceMeters>{}</DistanceMeters>'
+                '</Lap>'.format(start, seconds, distance) for distance, seconds in laps)).encode('utf-8')
+
+
+# File name -> TCX contents; the Biking one is left out when parsing Running activities
+ACTIVITIES = {'2018-01-03_3.txt': tcx('2018-01-03T10:00:00.000Z', [(1000.0, 300.0), (1000.0, 290.0), (500.0, 140.0)]),
+              '2018-01-01_1.txt': tcx('2018-01-01T10:00:00.000Z', [(5000.0, 1500.0)]),
+              '2018-01-02_2.txt': tcx('2018-01-02T10:00:00.000Z', [(20000.0, 2400.0)], 'Biking'),
+              '2018-01-04_4.txt': tcx('2018-01-04T10:00:00.000Z', [(1000.0, 310.0), (1000.0, 305.0)])}
+
+
+def write_activities(folder, compression=None):
+    """
+    Write ACTIVITIES as files in folder and return their paths, sorted by name
+    """
+    paths = []
+    for name, contents in sorted(ACTIVITIES.items()):
+        paths.append(storage.write_file(os.path.join(folder, name), contents, compression))
+    return paths
+
+
+def check_parsed(parsed, names, suffix=''):
+    """
+    Assert that parsed holds the Running activities of ACTIVITIES named names (with suffix), in that order
+    """
+    assert [os.path.basename(path) for path in parsed.paths] == [name + suffix for name in names]
+    assert len(parsed) == len(names)
+    assert list(parsed.timestamps) == [gcparser.isoToEpoch('{}T10:00:00Z'.format(name[:10])) for name in names]
+    for i, name in enumerate(names):
+        expected = gcparser.GCFileParser(None, fileobj=io.BytesIO(ACTIVITIES[name])).parse()
+        distances, times = parsed.splits(i)
+        assert list(distances) == list(expected[1])
+        assert list(times) == list(expected[2])
+
+
+# Three trackpoints: a full one, one with only a time and distance, and one without altitude. The lap's own
+# distance and average heart rate must not end up in the track.
+TRACK_TCX = b"""<?xml version="1.0"?>
+<TrainingCenterDatabase xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">
+ <Activities><Activity Sport="Running"><Id>2018-01-01T10:00:00.000Z</Id>
+  <Lap StartTime="2018-01-01T10:00:00.000Z">
+   <TotalTimeSeconds>10.0</TotalTimeSeconds><DistanceMeters>30.0</DistanceMeters>
+   <AverageHeartRateBpm><Value>125</Value></AverageHeartRateBpm>
+   <Track>
+    <Trackpoint><Time>2018-01-01T10:00:00.000Z</Time>
+     <Position><LatitudeDegrees>52.1</LatitudeDegrees><LongitudeDegrees>4.3</LongitudeDegrees></Position>
+     <AltitudeMeters>1.5</AltitudeMeters><DistanceMeters>0.0</DistanceMeters>
+     <HeartRateBpm><Value>120</Value></HeartRateBpm>
+     <Extensions><ns3:TPX><ns3:Speed>3.0</ns3:Speed><ns3:RunCadence>80</ns3:RunCadence></ns3:TPX></Extensions>
+    </Trackpoint>
+    <Trackpoint><Time>2018-01-01T10:00:05.000Z</Time><DistanceMeters>15.0</DistanceMeters></Trackpoint>
+    <Trackpoint><Time>2018-01-01T10:00:10.500Z</Time>
+     <Position><LatitudeDegrees>52.2</LatitudeDegrees><LongitudeDegrees>4.4</LongitudeDegrees></Position>
+     <DistanceMeters>30.0</DistanceMeters><HeartRateBpm><Value>130</Value></HeartRateBpm>
+     <Extensions><ns3:TPX><ns3:RunCadence>82</ns3:RunCadence></ns3:TPX></Extensions>
+    </Trackpoint>
+   </Track>
+  </Lap>
+ </Activity></Activities>
+</TrainingCenterDatabase>"""
+
+
+def assert_column(values, expected):
+    """
+    Assert that values equals expected, with None for NaN
+    """
+    assert [None if np.isnan(value) else value for value in values] == expected
+
+
+@pytest.mark.parametrize('capacity', [0, 1, 2, 4096])
+def test_trackpoints(capacity):
+    analyze = gcparser.GCFileParser(None, fileobj=io.BytesIO(TRACK_TCX), trackpoints=True, capacity=capacity)
+    timestamp, distances, times = analyze.parse()
+    assert timestamp == 1514800800
+    assert list(distances) == [30.0]
+    assert list(times) == [10.0]
+
+    points = analyze.points()
+    assert sorted(points) == sorted(gcparser.TRACK_FIELDS)
+    assert_column(points['time'], [1514800800.0, 1514800805.0, 1514800810.5])
+    assert_column(points['distance'], [0.0, 15.0, 30.0])
+    assert_column(points['heartrate'], [120.0, None, 130.0])
+    assert_column(points['cadence'], [80.0, None, 82.0])
+    assert_column(points['altitude'], [1.5, None, None])
+    assert_column(points['latitude'], [52.1, None, 52.2])
+    assert_column(points['longitude'], [4.3, None, 4.4])
+
+
+def test_trackpoints_of_other_sport():
+    analyze = gcparser.GCFileParser(None, 'Biking', fileobj=io.BytesIO(TRACK_TCX), trackpoints=True)
+    assert analyze.parse() == [None, None, None]
+    assert all(len(values) == 0 for values in analyze.points().values())
+
+
+def test_without_trackpoints():
+    analyze = gcparser.GCFileParser(None, fileobj=io.BytesIO(TRACK_TCX))
+    timestamp, distances, times = analyze.parse()
+    assert list(distances) == [30.0]
+    assert not hasattr(analyze, 'track')
+
+
+TIMESTAMPS = ['2018-01-01T10:00:00.000Z', '2018-01-01T10:00:00Z', '2018-01-01T10:00:00', '2018-06-30T23:59:59.5Z',
+              '2018-06-30T23:59:59.123456Z', '2018-01-01T10:00:00.250+02:00', '2018-01-01T10:00:00-05:30',
+              '2000-02-29T12:00:00Z', '2100-03-01T00:00:00Z', '1969-12-31T23:59:59Z', '1970-01-01T00:00:00.1Z']
+
+
+def test_iso_to_epoch_array_matches_iso_to_epoch():
+    seconds = gcparser.isoToEpochArray(TIMESTAMPS)
+    assert seconds.shape == (len(TIMESTAMPS),)
+    assert np.allclose(seconds, [gcparser.isoToEpoch(value) for value in TIMESTAMPS], rtol=0, atol=1e-6)
+
+
+def test_iso_to_epoch_array_known_values():
+    seconds = gcparser.isoToEpochArray(['1970-01-01T00:00:00Z', '2018-01-01T10:00:00.000Z',
+                                        '2018-01-01T12:00:00+02:00'])
+    assert list(seconds) == [0, 1514800800, 1514800800]
+
+
+def test_iso_to_epoch_array_empty_strings():
+    seconds = gcparser.isoToEpochArray(['', '2018-01-01T10:00:00Z', ''])
+    assert np.isnan(seconds[0]) and np.isnan(seconds[2])
+    assert seconds[1] == 1514800800
+    assert gcparser.isoToEpochArray([]).shape == (0,)
+
+
+def test_iso_to_epoch_array_takes_bytes():
+    values = np.array([value.encode('ascii') for value in TIMESTAMPS], dtype='S%d' % gcparser.ISO_WIDTH)
+    assert np.array_equal(gcparser.isoToEpochArray(values), gcparser.isoToEpochArray(TIMESTAMPS))
+
+
+def test_parse_many_leaves_out_other_sports(tmpdir):
+    paths = write_activities(str(tmpdir))
+    parsed = gcparser.parseMany(paths, workers=1)
+    check_parsed(parsed, ['2018-01-01_1.txt', '2018-01-03_3.txt', '2018-01-04_4.txt'])
+    assert list(parsed.offsets) == [0, 1, 4, 6]
+    assert list(parsed.splits(1)[1]) == [300.0, 290.0, 140.0]
+
+    biking = gcparser.parseMany(paths, 'Biking', workers=1)
+    assert [os.path.basename(path) for path in biking.paths] == ['2018-01-02_2.txt']
+    assert list(biking.distances) == [20000.0]
+
+
+def test_parse_many_keeps_the_order_of_paths(tmpdir):
+    paths = write_activities(str(tmpdir))[::-1]
+    check_parsed(gcparser.parseMany(paths, workers=1), ['2018-01-04_4.txt', '2018-01-03_3.txt', '2018-01-01_1.txt'])
+
+
+def test_parse_many_workers(tmpdir):
+    paths = write_activities(str(tmpdir), 'gzip')
+    serial = gcparser.parseMany(paths, workers=1)
+    check_parsed(serial, ['2018-01-01_1.txt', '2018-01-03_3.txt', '2018-01-04_4.txt'], '.gz')
+    parallel = gcparser.parseMany(paths, workers=3)
+    assert parallel.paths == serial.paths
+    for name in ['timestamps', 'distances', 'times', 'offsets']:
+        assert np.array_equal(getattr(parallel, name), getattr(serial, name))
+
+
+def test_parse_many_packed(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder)
+    for name, contents in ACTIVITIES.items():
+        pack.write(name, contents)
+    names = sorted(ACTIVITIES)
+    for workers in [1, 2]:
+        check_parsed(gcparser.parseMany(names, workers=workers, directory=folder),
+                     ['2018-01-01_1.txt', '2018-01-03_3.txt', '2018-01-04_4.txt'])
+
+
+def test_parse_many_nothing():
+    parsed = gcparser.parseMany([], workers=1)
+    assert len(parsed) == 0
+    assert list(parsed.offsets) == [0]
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """
+    Paths parseMany was asked to parse, per call
+    """
+    calls = []
+    parse_many = gcparser.parseMany
+
+    def counting(paths, *args, **kwargs):
+        calls.append([os.path.basename(path) for path in paths])
+        return parse_many(paths, *args, **kwargs)
+    monkeypatch.setattr(gcparser, 'parseMany', counting)
+    return calls
+
+
+def test_parse_cached_only_parses_changed_files(tmpdir, monkeypatch, parses):
+    folder, cache = str(tmpdir.mkdir('files')), str(tmpdir.join('cache'))
+    paths = write_activities(folder)
+    names = ['2018-01-01_1.txt', '2018-01-03_3.txt', '2018-01-04_4.txt']
+    check_parsed(gcparser.parseCached(paths, cache, workers=1), names)
+    assert parses == [sorted(ACTIVITIES)]
+
+    # Nothing changed: the cached arrays are returned without parsing anything
+    del parses[:]
+    check_parsed(gcparser.parseCached(paths, cache, workers=1), names)
+    assert parses == []
+
+    monkeypatch.setitem(ACTIVITIES, '2018-01-03_3.txt', tcx('2018-01-03T10:00:00.000Z', [(3000.0, 900.0)]))
+    storage.write_file(paths[2], ACTIVITIES['2018-01-03_3.txt'])
+    check_parsed(gcparser.parseCached(paths, cache, workers=1), names)
+    assert parses == [['2018-01-03_3.txt']]
+
+
+def test_parse_cached_follows_the_paths(tmpdir, parses):
+    folder, cache = str(tmpdir.mkdir('files')), str(tmpdir.join('cache'))
+    paths = write_activities(folder)
+    gcparser.parseCached(paths, cache, workers=1)
+
+    # Leaving a file out drops it without parsing the others again
+    del parses[:]
+    check_parsed(gcparser.parseCached(paths[:2] + paths[3:], cache, workers=1),
+                 ['2018-01-01_1.txt', '2018-01-04_4.txt'])
+    assert parses == [[]]
+    check_parsed(gcparser.parseCached(paths[::-1], cache, workers=1),
+                 ['2018-01-04_4.txt', '2018-01-03_3.txt', '2018-01-01_1.txt'])
+    assert parses == [[], ['2018-01-03_3.txt']]
+
+
+def test_parse_cached_other_sport(tmpdir, parses):
+    folder, cache = str(tmpdir.mkdir('files')), str(tmpdir.join('cache'))
+    paths = write_activities(folder)
+    gcparser.parseCached(paths, cache, workers=1)
+    biking = gcparser.parseCached(paths, cache, 'Biking', workers=1)
+    assert [os.path.basename(path) for path in biking.paths] == ['2018-01-02_2.txt']
+    assert parses == [sorted(ACTIVITIES), sorted(ACTIVITIES)]
+
+
+def test_parse_cached_swaps_generations(tmpdir):
+    folder, cache = str(tmpdir.mkdir('files')), str(tmpdir.join('cache'))
+    paths = write_activities(folder)
+    gcparser.parseCached(paths, cache, workers=1)
+    assert sorted(os.listdir(cache)) == sorted(['index.json'] + ['{}.1.npy'.format(name)
+                                                                 for name in gcparser.CACHE_ARRAYS])
+    gcparser.parseCached(paths[1:], cache, workers=1)
+    assert sorted(os.listdir(cache)) == sorted(['index.json'] + ['{}.2.npy'.format(name)
+                                                                 for name in gcparser.CACHE_ARRAYS])
+
+
+def test_parse_cached_packed(tmpdir, parses):
+    folder, cache = str(tmpdir), str(tmpdir.join('cache'))
+    pack = storage.PackStore(folder)
+    for name, contents in ACTIVITIES.items():
+        pack.write(name, contents)
+    names = sorted(ACTIVITIES)
+    running = ['2018-01-01_1.txt', '2018-01-03_3.txt', '2018-01-04_4.txt']
+    check_parsed(gcparser.parseCached(names, cache, workers=1, directory=folder), running)
+    check_parsed(gcparser.parseCached(names, cache, workers=1, directory=folder), running)
+    assert parses == [names]
+
+    # A record written again lands elsewhere in the pack, so it is parsed again
+    pack.write('2018-01-04_4.txt', ACTIVITIES['2018-01-04_4.txt'])
+    check_parsed(gcparser.parseCached(names, cache, workers=1, directory=folder), running)
+    assert parses == [names, ['2018-01-04_4.txt']]
@@ -0,0 +1,160 @@
+import math
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import running
+
+nan = float('nan')
+
+
+def activities(seed=1):
+    """
+    Trackpoints of a few activities, concatenated: times, distances, altitudes, heart rates and offsets. The
+    third activity has no heart rate at all, the fourth no trackpoints, and there are gaps everywhere.
+    """
+    random = np.random.RandomState(seed)
+    lengths = [400, 250, 300, 0, 120]
+    times, distances, altitudes, heartrates = [], [], [], []
+    for number, length in enumerate(lengths):
+        steps = random.uniform(1, 5, length)
+        times.append(np.cumsum(steps) + 1000.0 * number)
+        distances.append(np.cumsum(steps * random.uniform(2.0, 4.5, length)))
+        altitudes.append(10 + np.cumsum(random.normal(0, 0.5, length)))
+        rates = random.uniform(90, 190, length)
+        if number == 2:
+            rates[:] = nan
+        heartrates.append(rates)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    arrays = [np.concatenate(values) for values in [times, distances, altitudes, heartrates]]
+    for values in arrays[1:]:
+        gaps = random.uniform(0, 1, np.size(values)) < 0.05
+        values[gaps] = nan
+    # Gaps at the start of an activity
+    arrays[3][offsets[1]:offsets[1] + 3] = nan
+    arrays[2][offsets[4]] = nan
+    return arrays + [offsets]
+
+
+def each(offsets):
+    for i in range(len(offsets) - 1):
+        yield i, offsets[i], offsets[i + 1]
+
+
+def fill_loop(values, offsets):
+    filled = []
+    for _, start, end in each(offsets):
+        activity = list(values[start:end])
+        known = [value for value in activity if not math.isnan(value)]
+        last = known[0] if known else nan
+        for value in activity:
+            if not math.isnan(value):
+                last = value
+            filled.append(last)
+    return np.array(filled)
+
+
+def test_fill_gaps_stays_within_activity():
+    values = np.array([nan, 1, nan, 3, nan, nan, nan, 5])
+    filled = running.fillGaps(values, [0, 3, 5, 6, 8])
+    np.testing.assert_array_equal(filled, [1, 1, 1, 3, 3, nan, 5, 5])
+
+
+def test_fill_gaps_matches_loop():
+    for values in activities()[1:4]:
+        offsets = activities()[4]
+        np.testing.assert_array_equal(running.fillGaps(values, offsets), fill_loop(values, offsets))
+
+
+def test_rolling_pace():
+    times, distances, _, _, offsets = activities()
+    paces = running.rollingPace(times, distances, offsets, window=60.0)
+    times, distances = fill_loop(times, offsets), fill_loop(distances, offsets)
+    expected = []
+    for _, start, end in each(offsets):
+        for j in range(start, end):
+            first = min(k for k in range(start, j + 1) if times[k] - times[start] >= times[j] - times[start] - 60.0)
+            covered = distances[j] - distances[first]
+            expected.append((times[j] - times[first]) / covered if covered > 0 else nan)
+    np.testing.assert_allclose(paces, expected)
+
+
+def test_best_efforts():
+    times, distances, _, _, offsets = activities()
+    targets = {'400m': 400.0, '1k': 1000.0, 'far': 5000.0}
+    efforts = running.bestEfforts(times, distances, offsets, targets)
+    times, distances = fill_loop(times, offsets), fill_loop(distances, offsets)
+    for name, target in targets.items():
+        expected = []
+        for _, start, end in each(offsets):
+            best = nan
+            for j in range(start, end):
+                before = [i for i in range(start, j) if distances[i] <= distances[j] - target]
+                if not before:
+                    continue
+                i = before[-1]
+                step = distances[i + 1] - distances[i]
+                fraction = (distances[j] - target - distances[i]) / step if step > 0 else 0.0
+                fraction = min(max(fraction, 0.0), 1.0)
+                duration = times[j] - (times[i] + fraction * (times[i + 1] - times[i]))
+                best = duration if math.isnan(best) else min(best, duration)
+            expected.append(best)
+        np.testing.assert_allclose(efforts[name], expected)
+    assert np.isnan(efforts['far']).all()
+
+
+def test_grade_adjusted_paces():
+    times, distances, altitudes, _, offsets = activities()
+    paces = running.gradeAdjustedPaces(times, distances, altitudes, offsets)
+    times, distances, altitudes = [fill_loop(values, offsets) for values in [times, distances, altitudes]]
+    expected = []
+    for _, start, end in each(offsets):
+        elapsed, flat = 0.0, 0.0
+        for k in range(start + 1, end):
+            run = distances[k] - distances[k - 1]
+            grade = (altitudes[k] - altitudes[k - 1]) / run if run > 0 else 0.0
+            grade = min(max(grade, -0.45), 0.45)
+            cost = (155.4 * grade ** 5 - 30.4 * grade ** 4 - 43.3 * grade ** 3 + 46.3 * grade ** 2 +
+                    19.5 * grade + 3.6)
+            flat += run * cost / 3.6
+            elapsed += times[k] - times[k - 1]
+        expected.append(elapsed / flat if flat else nan)
+    np.testing.assert_allclose(paces, expected)
+
+
+def test_trimp():
+    times, _, _, heartrates, offsets = activities()
+    trimps = running.trimp(times, heartrates, offsets, 50, 190)
+    times, heartrates = fill_loop(times, offsets), fill_loop(heartrates, offsets)
+    expected = []
+    for i, start, end in each(offsets):
+        if end == start or math.isnan(heartrates[start]):
+            expected.append(nan)
+            continue
+        load = 0.0
+        for k in range(start + 1, end):
+            reserve = min(max((heartrates[k] - 50) / 140.0, 0.0), 1.0)
+            load += (times[k] - times[k - 1]) / 60.0 * reserve * 0.64 * math.exp(1.92 * reserve)
+        expected.append(load)
+    np.testing.assert_allclose(trimps, expected)
+    # The activity without heart rate gets no load, not the heart rate of the next one
+    assert np.isnan(trimps[2])
+    assert trimps[0] > 0 and trimps[4] > 0
+
+
+def test_kilometer_splits():
+    times, distances, _, _, offsets = activities()
+    splits, splitOffsets = running.kilometerSplits(times, distances, offsets)
+    times, distances = fill_loop(times, offsets), fill_loop(distances, offsets)
+    expected, counts = [], []
+    for _, start, end in each(offsets):
+        if end == start:
+            counts.append(0)
+            continue
+        number = int((distances[end - 1] - distances[start]) // 1000.0)
+        marks = distances[start] + 1000.0 * np.arange(number + 1)
+        expected.extend(np.diff(np.interp(marks, distances[start:end], times[start:end])))
+        counts.append(number)
+    np.testing.assert_array_equal(np.diff(splitOffsets), counts)
+    np.testing.assert_allclose(splits, expected)
@@ -0,0 +1,186 @@
+import json
+import os
+
+import pytest
+
+import storage
+
+
+def write_manifest(folder, entries):
+    with open(os.path.join(folder, 'manifest.jsonl'), 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+
+MIXED_SPORTS = [{'activityId': '1', 'date': '2019-01-01', 'file': '2019-01-01_1.txt', 'sport': 'Running'},
+                {'activityId': '2', 'date': '2019-01-02', 'file': '2019-01-02_2.txt', 'sport': 'Biking'},
+                {'activityId': '3', 'date': '2019-01-03', 'file': '2019-01-03_3.txt'},
+                {'activityId': '4', 'date': '2019-01-04', 'file': '2019-01-04_4.txt', 'sport': 'Other'}]
+
+
+def test_activity_id():
+    assert storage.activity_id('2019-01-02_123.txt') == '123'
+    assert storage.activity_id('/data/2019-01-02_123.txt.gz') == '123'
+    assert storage.activity_id('2019-01-02_summary.json') is None
+    assert storage.activity_id('run.tcx') is None
+
+
+def test_activity_files_skips_other_sports(tmpdir):
+    folder = str(tmpdir)
+    for entry in MIXED_SPORTS:
+        storage.write_file(os.path.join(folder, entry['file']), b'<tcx/>', 'gzip' if entry['activityId'] == '1' else None)
+    storage.write_file(os.path.join(folder, 'handmade.tcx'), b'<tcx/>')
+    storage.write_file(os.path.join(folder, 'notes.txt'), b'')
+    write_manifest(folder, MIXED_SPORTS)
+
+    names = [os.path.basename(path) for path in storage.activity_files(folder, 'Running')]
+    # The Biking and Other activities are left out; no sport recorded means it is kept
+    assert names == ['2019-01-01_1.txt.gz', '2019-01-03_3.txt', 'handmade.tcx']
+    assert len(storage.activity_files(folder)) == 5
+    assert [os.path.basename(path) for path in storage.activity_files(folder, 'Biking')] == \
+        ['2019-01-02_2.txt', '2019-01-03_3.txt', 'handmade.tcx']
+
+
+def test_activity_files_packed(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder)
+    for entry in MIXED_SPORTS:
+        pack.write(entry['file'], b'<tcx/>')
+    pack.write('2019-01-01_summary.json', b'{}')
+    write_manifest(folder, MIXED_SPORTS)
+
+    assert storage.activity_files(folder, 'Running') == ['2019-01-01_1.txt', '2019-01-03_3.txt']
+    assert storage.activity_files(folder) == [entry['file'] for entry in MIXED_SPORTS]
+
+
+def test_manifest_sports_last_entry_wins(tmpdir):
+    folder = str(tmpdir)
+    write_manifest(folder, MIXED_SPORTS + [{'activityId': 3, 'date': '2019-01-03', 'file': '2019-01-03_3.txt',
+                                            'sport': 'Running'}])
+    with open(os.path.join(folder, 'manifest.jsonl'), 'a') as f:
+        f.write('{"activityId": "5", "fi')
+    assert storage.manifest_sports(folder) == {'1': 'Running', '2': 'Biking', '3': 'Running', '4': 'Other'}
+    assert storage.manifest_sports(os.path.join(folder, 'missing')) == {}
+
+
+def test_pack_store_round_trip(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder, 'gzip')
+    pack.write('2018-12-31_summary.json', b'{"steps": 1}')
+    pack.write_chunks('2019-01-01_1.txt', iter([b'<tcx', b'/>']))
+    pack.write('2019-01-01_summary.json', b'{"steps": 2}')
+
+    assert storage.PackStore.present(folder)
+    assert isinstance(storage.open_store(folder), storage.PackStore)
+    reopened = storage.PackStore(folder)
+    assert reopened.years() == ['2018', '2019']
+    assert sorted(reopened.names()) == ['2018-12-31_summary.json', '2019-01-01_1.txt', '2019-01-01_summary.json']
+    assert reopened.read('2019-01-01_1.txt') == b'<tcx/>'
+    assert reopened.open('2018-12-31_summary.json').read() == b'{"steps": 1}'
+    assert reopened.find(date='2019-01-01') == ['2019-01-01_1.txt', '2019-01-01_summary.json']
+    assert reopened.find(activity_id=1) == ['2019-01-01_1.txt']
+    assert '2019-01-02_summary.json' not in reopened
+    with pytest.raises(KeyError):
+        reopened.read('2019-01-02_summary.json')
+
+
+def test_pack_store_ignores_cut_off_index_line(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder)
+    pack.write('2019-01-01_summary.json', b'{}')
+    with open(os.path.join(folder, '2019.idx'), 'a') as f:
+        f.write('{"name": "2019-01-02_summary.json", "off')
+    assert storage.PackStore(folder).names() == ['2019-01-01_summary.json']
+
+
+def test_pack_store_sees_writes_of_other_stores(tmpdir):
+    folder = str(tmpdir)
+    first, second = storage.PackStore(folder), storage.PackStore(folder)
+    first.write('2019-01-01_summary.json', b'one')
+    second.write('2019-01-02_summary.json', b'two')
+    first.write('2019-01-03_summary.json', b'three')
+    reopened = storage.PackStore(folder)
+    assert [reopened.read(name) for name in sorted(reopened.names())] == [b'one', b'two', b'three']
+
+
+def write_records(folder, prefix, count):
+    pack = storage.PackStore(folder)
+    for number in range(count):
+        pack.write('2019-01-{:02d}_{}.json'.format(number % 28 + 1, prefix), prefix.encode('utf-8') * 100)
+
+
+def test_pack_store_concurrent_processes(tmpdir):
+    import multiprocessing
+    folder = str(tmpdir)
+    processes = [multiprocessing.Process(target=write_records, args=(folder, prefix, 56))
+                 for prefix in ['a', 'b', 'c']]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    pack = storage.PackStore(folder)
+    assert len(pack.names()) == 3 * 28
+    for name in pack.names():
+        assert pack.read(name) == name[-6:-5].encode('utf-8') * 100
+    assert pack.garbage('2019') == 3 * 28 * 100
+
+
+def test_pack_store_compact(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder, 'gzip')
+    for version in range(4):
+        pack.write('2019-01-01_summary.json', 'version {}'.format(version).encode('utf-8'))
+        pack.write('2019-01-02_summary.json', b'{}')
+    pack.write('2018-01-01_summary.json', b'{}')
+    size = os.path.getsize(os.path.join(folder, '2019.pack'))
+    garbage = pack.garbage('2019')
+    assert garbage > 0 and pack.garbage('2018') == 0
+
+    # Not enough replaced records to bother
+    assert pack.compact(min_garbage=0.9) == 0
+    assert pack.compact() == garbage
+    assert os.path.getsize(os.path.join(folder, '2019.pack')) == size - garbage
+    for store in [pack, storage.PackStore(folder)]:
+        assert store.garbage('2019') == 0
+        assert store.read('2019-01-01_summary.json') == b'version 3'
+        assert store.read('2019-01-02_summary.json') == b'{}'
+    pack.write('2019-01-03_summary.json', b'after')
+    assert storage.PackStore(folder).read('2019-01-03_summary.json') == b'after'
+
+
+def test_pack_store_interrupted_compaction(tmpdir):
+    folder = str(tmpdir)
+    pack = storage.PackStore(folder)
+    pack.write('2019-01-01_summary.json', b'old')
+    pack.write('2019-01-01_summary.json', b'new')
+    pack_path, index_path = os.path.join(folder, '2019.pack'), os.path.join(folder, '2019.idx')
+
+    # Interrupted while writing the new pack: it is thrown away
+    with open(pack_path + '.part', 'wb') as f:
+        f.write(b'ne')
+    assert storage.PackStore(folder).read('2019-01-01_summary.json') == b'new'
+    pack.write('2019-01-02_summary.json', b'more')
+    assert not os.path.exists(pack_path + '.part')
+
+    # Interrupted between putting the new pack and its index in place: the index is put in place too
+    with open(pack_path + '.part', 'wb') as f:
+        f.write(b'newmore')
+    with open(index_path + '.part', 'w') as f:
+        f.write(json.dumps({'name': '2019-01-01_summary.json', 'offset': 0, 'length': 3, 'compression': None}) + '\n')
+        f.write(json.dumps({'name': '2019-01-02_summary.json', 'offset': 3, 'length': 4, 'compression': None}) + '\n')
+    os.rename(pack_path + '.part', pack_path)
+    reopened = storage.PackStore(folder)
+    assert reopened.read('2019-01-01_summary.json') == b'new'
+    assert reopened.read('2019-01-02_summary.json') == b'more'
+    assert reopened.garbage('2019') == 0
+
+
+def test_names_by_day_only_takes_day_records(tmpdir):
+    folder = str(tmpdir)
+    for name in ['2019-01-01_summary.json', '2019-01-01_heartrate.json', '2019-01-02_sleep.json',
+                 'build.json', 'notes_2019.json', '2019-01-03.json', '2019-01-03_1.txt']:
+        storage.write_file(os.path.join(folder, name), b'{}')
+
+    days = storage.names_by_day(storage.open_store(folder))
+    assert sorted(days) == ['2019-01-01', '2019-01-02']
+    assert sorted(days['2019-01-01']) == ['2019-01-01_heartrate.json', '2019-01-01_summary.json']
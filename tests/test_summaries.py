@@ -0,0 +1,139 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import summaries
+
+
+def rows(first, count):
+    """
+    Rows of count activities with ids from first on, one every three days from 2018-12-20, alternating sports;
+    every third one has no calorie count
+    """
+    result = []
+    for number in range(first, first + count):
+        day = np.datetime64('2018-12-20') + 3 * number
+        item = {'activityId': number, 'startTimeLocal': '{} 07:30:00'.format(day),
+                'activityType': {'typeKey': 'running' if number % 2 else 'cycling'},
+                'distance': 1000.0 * number, 'duration': 300.0 * number,
+                'calories': None if number % 3 == 0 else 70.0 * number}
+        result.append(summaries.summary_row(item, 'Running' if number % 2 else 'Biking'))
+    return result
+
+
+def full_rollups(folder, sport=None):
+    """
+    Totals of every period, counted from scratch over the whole dataset of folder
+    """
+    all_rows, _ = summaries.read_rows(folder)
+    if sport is not None:
+        all_rows = [row for row in all_rows if row[2] == sport]
+    columns = summaries.to_columns(all_rows)
+    return dict((period, summaries.rollup(columns, period)) for period in summaries.PERIODS)
+
+
+def check_rollups(state, expected):
+    for period in summaries.PERIODS:
+        assert sorted(state[period]) == sorted(expected[period])
+        for start, totals in expected[period].items():
+            for name in summaries.ROLLUP_TOTALS:
+                assert state[period][start][name] == pytest.approx(totals[name])
+
+
+@pytest.mark.parametrize('sport', [None, 'Running'])
+def test_incremental_rollups_match_full(tmpdir, sport):
+    folder = str(tmpdir)
+    known = set()
+    for first, count in [(1, 5), (6, 1), (7, 12), (19, 30)]:
+        summaries.add_summaries(folder, known, rows(first, count))
+        state = summaries.update_rollups(folder, sport)
+        check_rollups(state, full_rollups(folder, sport))
+        assert state['offset'] == os.path.getsize(os.path.join(folder, summaries.SUMMARIES))
+
+    # Read back from rollups.json, with nothing new to add
+    check_rollups(summaries.update_rollups(folder, sport), full_rollups(folder, sport))
+
+
+def test_rollups_only_read_new_rows(tmpdir, monkeypatch):
+    folder = str(tmpdir)
+    known = set()
+    summaries.add_summaries(folder, known, rows(1, 10))
+    summaries.update_rollups(folder)
+
+    read = []
+    read_rows = summaries.read_rows
+
+    def counting(folder, offset=0):
+        result = read_rows(folder, offset)
+        read.append(len(result[0]))
+        return result
+    monkeypatch.setattr(summaries, 'read_rows', counting)
+    summaries.add_summaries(folder, known, rows(11, 3))
+    summaries.update_rollups(folder)
+    summaries.update_rollups(folder)
+    assert read == [3, 0]
+
+
+def test_rollups_start_over(tmpdir):
+    folder = str(tmpdir)
+    known = set()
+    summaries.add_summaries(folder, known, rows(1, 20))
+    summaries.update_rollups(folder, 'Running')
+
+    # Another sport is counted from scratch
+    check_rollups(summaries.update_rollups(folder, 'Biking'), full_rollups(folder, 'Biking'))
+
+    # And so is a dataset that was replaced by a shorter one
+    os.remove(os.path.join(folder, summaries.SUMMARIES))
+    summaries.add_summaries(folder, set(), rows(1, 2))
+    state = summaries.update_rollups(folder, 'Biking')
+    check_rollups(state, full_rollups(folder, 'Biking'))
+    assert sum(totals['count'] for totals in state['year'].values()) == 1
+
+
+def test_rollups_leave_cut_off_line(tmpdir):
+    folder = str(tmpdir)
+    known = set()
+    summaries.add_summaries(folder, known, rows(1, 4))
+    with open(os.path.join(folder, summaries.SUMMARIES), 'a') as f:
+        f.write('5,2018-12-')
+    state = summaries.update_rollups(folder)
+    assert sum(totals['count'] for totals in state['year'].values()) == 4
+
+    # The next run ends the damaged line, which is then skipped
+    summaries.add_summaries(folder, known, rows(5, 3))
+    state = summaries.update_rollups(folder)
+    check_rollups(state, full_rollups(folder))
+    assert sum(totals['count'] for totals in state['year'].values()) == 7
+
+
+def test_rollup_periods(tmpdir):
+    folder = str(tmpdir)
+    summaries.add_summaries(folder, set(), rows(1, 6))
+    state = summaries.update_rollups(folder)
+    # Weeks start on Monday: 2018-12-23 is a Sunday and 2018-12-29 a Saturday
+    assert sorted(state['week']) == ['2018-12-17', '2018-12-24', '2018-12-31', '2019-01-07']
+    assert sorted(state['month']) == ['2018-12-01', '2019-01-01']
+    assert state['month']['2018-12-01']['count'] == 3
+    assert state['year']['2019-01-01']['distance'] == 15000.0
+    # Activity 3 has no calorie count, so its distance does not count towards the calories per meter
+    assert state['month']['2018-12-01']['caloriesDistance'] == 3000.0
+    assert summaries.estimated_calories(state['month']['2018-12-01']) == pytest.approx(210.0 * 6 / 3)
+
+
+def test_rollups_without_dataset(tmpdir):
+    folder = str(tmpdir)
+    # An archive downloaded before the summaries were kept
+    state = summaries.update_rollups(folder, 'Running')
+    assert state['offset'] == 0
+    assert all(state[period] == {} for period in summaries.PERIODS)
+    assert len(summaries.load_summaries(folder)['activityId']) == 0
+
+    summaries.add_summaries(folder, set(), rows(1, 4))
+    check_rollups(summaries.update_rollups(folder, 'Running'), full_rollups(folder, 'Running'))
+
+    # And again when the dataset is gone after rollups were counted
+    os.remove(os.path.join(folder, summaries.SUMMARIES))
+    assert summaries.update_rollups(folder, 'Running')['month'] == {}
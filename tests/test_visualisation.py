@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+pytest.importorskip('jinja2')
+
+import storage
+import visualisation
+
+
+def write(folder, date, kind, contents=b'[]'):
+    storage.write_file(os.path.join(folder, '{}_{}.json'.format(date, kind)), contents)
+
+
+@pytest.fixture
+def folders(tmpdir):
+    """
+    Wellness folder with three days (and a day without summary), output folder and template folder
+    """
+    inputdir, outputdir, templates = [str(tmpdir.mkdir(name)) for name in ['Wellness', 'www', 'templates']]
+    for date in ['2019-01-01', '2019-01-02', '2019-01-03']:
+        write(inputdir, date, 'summary')
+        write(inputdir, date, 'heartrate')
+    write(inputdir, '2019-01-04', 'heartrate')
+    write(inputdir, 'build', 'notes')
+    with open(os.path.join(templates, 'dailystats.html'), 'w') as f:
+        f.write('{{ datestamp }}')
+    return inputdir, outputdir, templates
+
+
+def build(inputdir, outputdir, templates, force=False):
+    """
+    Plan a build and pretend to generate its pages; returns the sorted dates that were planned
+    """
+    dates, nextdays, manifest = visualisation.plan_build(storage.open_store(inputdir), outputdir, templates, force)
+    for date in dates:
+        with open(os.path.join(outputdir, date + '.html'), 'w') as f:
+            f.write(date)
+    visualisation.save_build_manifest(outputdir, manifest)
+    return sorted(dates)
+
+
+def test_first_build_plans_all_days(folders):
+    inputdir, outputdir, templates = folders
+    dates, nextdays, manifest = visualisation.plan_build(storage.open_store(inputdir), outputdir, templates)
+    assert sorted(dates) == ['2019-01-01', '2019-01-02', '2019-01-03']
+    assert nextdays == {'2019-01-01': '2019-01-02', '2019-01-02': '2019-01-03', '2019-01-03': None}
+    assert sorted(manifest['pages']) == sorted(dates)
+
+
+def test_unchanged_days_are_skipped(folders):
+    inputdir, outputdir, templates = folders
+    build(inputdir, outputdir, templates)
+    assert build(inputdir, outputdir, templates) == []
+
+    write(inputdir, '2019-01-02', 'heartrate', b'[[1, 60]]')
+    assert build(inputdir, outputdir, templates) == ['2019-01-02']
+    assert build(inputdir, outputdir, templates) == []
+
+
+def test_new_day_rebuilds_the_one_before(folders):
+    inputdir, outputdir, templates = folders
+    build(inputdir, outputdir, templates)
+    # The day that had no summary yet gets one, so the page of the day before links to it
+    write(inputdir, '2019-01-04', 'summary')
+    assert build(inputdir, outputdir, templates) == ['2019-01-03', '2019-01-04']
+
+
+def test_missing_pages_are_rebuilt(folders):
+    inputdir, outputdir, templates = folders
+    build(inputdir, outputdir, templates)
+    os.remove(os.path.join(outputdir, '2019-01-01.html'))
+    assert build(inputdir, outputdir, templates) == ['2019-01-01']
+
+
+def test_template_change_and_force_rebuild_all(folders):
+    inputdir, outputdir, templates = folders
+    build(inputdir, outputdir, templates)
+    assert build(inputdir, outputdir, templates, force=True) == ['2019-01-01', '2019-01-02', '2019-01-03']
+    with open(os.path.join(templates, 'base.html'), 'w') as f:
+        f.write('<html></html>')
+    assert build(inputdir, outputdir, templates) == ['2019-01-01', '2019-01-02', '2019-01-03']
+    assert build(inputdir, outputdir, templates) == []
+
+
+def test_packed_wellness_folder(tmpdir):
+    inputdir, outputdir, templates = [str(tmpdir.mkdir(name)) for name in ['Wellness', 'www', 'templates']]
+    pack = storage.PackStore(inputdir)
+    for date in ['2019-01-01', '2019-01-02']:
+        pack.write('{}_summary.json'.format(date), b'[]')
+    assert build(inputdir, outputdir, templates) == ['2019-01-01', '2019-01-02']
+    assert build(inputdir, outputdir, templates) == []
+
+    # Writing a record again appends a new copy, which counts as a change even with the same contents
+    pack.write('2019-01-01_summary.json', b'[]')
+    assert build(inputdir, outputdir, templates) == ['2019-01-01']
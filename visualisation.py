@@ -1,12 +1,23 @@
 import argparse
+import calendar
+import collections
 from datetime import datetime, timedelta
-import json
+import glob
+import hashlib
 import logging
+import json
+import multiprocessing
 import os
 import sys
 
 import jinja2
 
+import columnar
+import storage
+
+# Record of what every page in the output directory was generated from, see plan_build
+BUILD_MANIFEST = 'build.json'
+
 
 def get_logger():
     """
@@ -154,40 +165,104 @@ def parse_wellness(wellness, content):
     return wellness
 
 
-def parse_files(logger, directory, target_directory):
+def columns_to_graphdata(steps):
+    """
+    summary_to_graphdata of the steps series of a day in the columnar store
+    """
+    keys = dict((columnar.ACTIVITY_LEVELS[name], key)
+                for name, key in [('sleeping', 'sleeping_steps'), ('active', 'active_steps'),
+                                  ('highlyActive', 'highlyactive_steps'), ('sedentary', 'sedentary_steps'),
+                                  ('generic', 'generic_steps')])
+    data = dict((key, []) for key in keys.values())
+    data['datetime'] = [unix_to_python(time // 1000).strftime('%Y-%m-%dT%H:%M:%S.0Z') for time in steps['time']]
+    data['totalsteps'] = [int(total) for total in steps['value'].cumsum(dtype='int64')]
+    for value, level in zip(steps['value'], steps['level']):
+        for key in keys.values():
+            data[key].append(0)
+        if level in keys:
+            data[keys[level]][-1] = int(value)
+    return data
+
+
+def pairs_to_graphdata(series, keep=lambda value: True):
+    """
+    List of [time string, value] of a heart rate or stress series of a day in the columnar store
+    """
+    return [[python_to_string(time // 1000), int(value) if value == value else None]
+            for time, value in zip(series['time'], series['value']) if keep(value)]
+
+
+def parse_columns(columns, dates=None):
+    """
+    parse_files from the columnar store (see columnar.py) instead of the files
+    """
     heartrate = {}
     stress = {}
     sleep = {}
     summary = []
     wellness = {}
-    for filename in sorted(os.listdir(directory)):
-        if filename.endswith("_summary.json"):
+    for date in columns.days:
+        if dates is not None and date not in dates:
+            continue
+        steps = columns.series('steps', date)
+        if len(steps['time']):
+            summary.append((date, columns_to_graphdata(steps)))
+        if len(columns.series('heartrate', date)['time']):
+            heartrate[date] = pairs_to_graphdata(columns.series('heartrate', date))
+        if len(columns.series('stress', date)['time']):
+            stress[date] = pairs_to_graphdata(columns.series('stress', date), lambda level: level > 0)
+        if columns.sleep(date) is not None:
+            sleep[date] = sleep_to_graphdata({'dailySleepDTO': {'sleepStartTimestampGMT': columns.sleep(date)[0],
+                                                                'sleepEndTimestampGMT': columns.sleep(date)[1]}})
+        if columns.metrics(date) is not None:
+            wellness = parse_wellness(wellness, {'allMetrics': {'metricsMap': columns.metrics(date)}})
+
+    # Reverse list so latest days are on top
+    summary = summary[::-1]
+
+    return {'summaries': summary, 'wellness': wellness, 'heartrate': heartrate, 'stress': stress, 'sleep': sleep}
+
+
+def parse_files(logger, directory, target_directory, dates=None):
+    """
+    Read the Wellness files in directory; with dates, only those of these days (yyyy-mm-dd). With NumPy installed
+    they are read from the columnar store, which is brought up to date first (see columnar.py).
+    """
+    if columnar.available():
+        return parse_columns(columnar.ingest(directory, dates), dates)
+
+    heartrate = {}
+    stress = {}
+    sleep = {}
+    summary = []
+    wellness = {}
+    # Files can be stored compressed or packed per year, see storage.py
+    store = storage.open_store(directory)
+    for name in sorted(store.names()):
+        if dates is not None and name.split('_')[0] not in dates:
+            continue
+        if name.endswith("_summary.json"):
             # parse summary, create graph
-            with open(os.path.join(directory, filename), 'r') as f:
-                content = json.load(f)
-            summary.append((filename.split('_')[0], summary_to_graphdata(content)))
-        elif filename.endswith("_heartrate.json"):
+            content = json.loads(store.read(name).decode('utf-8'))
+            summary.append((name.split('_')[0], summary_to_graphdata(content)))
+        elif name.endswith("_heartrate.json"):
             # parse heartrate, create graph
-            with open(os.path.join(directory, filename), 'r') as f:
-                content = json.load(f)
-            heartrate[filename.split('_')[0]] = heartrate_to_graphdata(content)
-        elif filename.endswith("_stress.json"):
+            content = json.loads(store.read(name).decode('utf-8'))
+            heartrate[name.split('_')[0]] = heartrate_to_graphdata(content)
+        elif name.endswith("_stress.json"):
             # parse stress, create graph
-            with open(os.path.join(directory, filename), 'r') as f:
-                content = json.load(f)
-            stress[filename.split('_')[0]] = stress_to_graphdata(content)
-        elif filename.endswith("_sleep.json"):
+            content = json.loads(store.read(name).decode('utf-8'))
+            stress[name.split('_')[0]] = stress_to_graphdata(content)
+        elif name.endswith("_sleep.json"):
             # parse stress, create graph
-            with open(os.path.join(directory, filename), 'r') as f:
-                content = json.load(f)
-            sleep[filename.split('_')[0]] = sleep_to_graphdata(content)
-        elif filename.endswith("_wellness.json"):
+            content = json.loads(store.read(name).decode('utf-8'))
+            sleep[name.split('_')[0]] = sleep_to_graphdata(content)
+        elif name.endswith("_wellness.json"):
             # parse wellness data
-            with open(os.path.join(directory, filename), 'r') as f:
-                content = json.load(f)
+            content = json.loads(store.read(name).decode('utf-8'))
             wellness = parse_wellness(wellness, content)
         else:
-            logger.info('Skipping file %s', filename)
+            logger.info('Skipping file %s', name)
             continue
 
     # Reverse list so latest days are on top
@@ -196,6 +271,113 @@ def parse_files(logger, directory, target_directory):
     return {'summaries': summary, 'wellness': wellness, 'heartrate': heartrate, 'stress': stress, 'sleep': sleep}
 
 
+def gmt_to_seconds(value):
+    """
+    Seconds since the epoch of a GMT time as in the daily summary, e.g. 2017-11-11T03:30:00.0
+    """
+    return calendar.timegm(datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').timetuple())
+
+
+def delta_encode(times):
+    """
+    Every time relative to the one before it (the first relative to 0)
+    """
+    deltas = []
+    previous = 0
+    for value in times:
+        deltas.append(value - previous)
+        previous = value
+    return deltas
+
+
+def timeseries(values, keep=lambda value: True):
+    """
+    Compact form of a list of [milliseconds, value] pairs: {t: delta encoded seconds, v: values}
+    """
+    values = [value for value in values or [] if keep(value[1])]
+    return {'t': delta_encode([value[0] // 1000 for value in values]), 'v': [value[1] for value in values]}
+
+
+def chart_json(data):
+    """
+    Compact JSON of the data of a chart, safe to put inside a <script> element
+    """
+    return json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+
+
+def chart_data(summary, heartrate, stress, sleep, goal):
+    """
+    JSON with the data of the chart of a day page, from the raw summary, heart rate, stress and sleep
+    files (each None when missing): numbers instead of strings, and times delta encoded
+    """
+    summary = summary or []
+    levels = []
+    for item in summary:
+        if item['primaryActivityLevel'] not in columnar.ACTIVITY_LEVELS:
+            logging.getLogger('garminvisualisation').warning('Unknown activity level found: %s', item)
+        levels.append(columnar.ACTIVITY_LEVELS.get(item['primaryActivityLevel'], -1))
+    sleep_end = (sleep or {}).get('dailySleepDTO', {}).get('sleepEndTimestampGMT')
+    return chart_json({'time': delta_encode([gmt_to_seconds(item['startGMT']) for item in summary]),
+                       'steps': [item['steps'] for item in summary],
+                       'level': levels,
+                       'goal': goal,
+                       'sleepEnd': sleep_end // 1000 if sleep_end else None,
+                       'stress': timeseries((stress or {}).get('stressValuesArray'), lambda level: level > 0),
+                       'heartrate': timeseries((heartrate or {}).get('heartRateValues'))})
+
+
+def columns_timeseries(series, keep=lambda value: True):
+    """
+    timeseries of a heart rate or stress series of a day in the columnar store
+    """
+    keep = [keep(value) for value in series['value']]
+    values = [int(value) if value == value else None for value in series['value'][keep]]
+    return {'t': delta_encode((series['time'][keep] // 1000).tolist()), 'v': values}
+
+
+def columns_chart_data(columns, datestamp, goal):
+    """
+    chart_data of a day in the columnar store (see columnar.py)
+    """
+    steps = columns.series('steps', datestamp)
+    sleep = columns.sleep(datestamp)
+    return chart_json({'time': delta_encode((steps['time'] // 1000).tolist()),
+                       'steps': steps['value'].astype(int).tolist(),
+                       'level': steps['level'].tolist(),
+                       'goal': goal,
+                       'sleepEnd': sleep[1] // 1000 if sleep else None,
+                       'stress': columns_timeseries(columns.series('stress', datestamp), lambda level: level > 0),
+                       'heartrate': columns_timeseries(columns.series('heartrate', datestamp))})
+
+
+def load_day(store, datestamp, columns=None):
+    """
+    Read the Wellness files of one day from store: the wellness metrics of that day, in the same structure as
+    parse_files returns for all days, and the data for its chart (see chart_data). Metrics missing that day
+    render empty instead of failing. With columns, the columnar store of the same files, the day is read from
+    that instead.
+    """
+    def read(kind):
+        name = '{}_{}.json'.format(datestamp, kind)
+        if name not in store:
+            return None
+        return json.loads(store.read(name).decode('utf-8'))
+
+    wellness = collections.defaultdict(dict)
+    if columns is not None and datestamp in columns:
+        if columns.metrics(datestamp) is not None:
+            parse_wellness(wellness, {'allMetrics': {'metricsMap': columns.metrics(datestamp)}})
+        goal = wellness['total_step_goal'].get(datestamp)
+        return {'wellness': wellness, 'chart': columns_chart_data(columns, datestamp, goal)}
+
+    content = read('wellness')
+    if content is not None:
+        parse_wellness(wellness, content)
+    goal = wellness['total_step_goal'].get(datestamp)
+    return {'wellness': wellness,
+            'chart': chart_data(read('summary'), read('heartrate'), read('stress'), read('sleep'), goal)}
+
+
 def generate_wellnesspage(template_dir, outputfile, alldata):
     """ Generate graphs for the various measurements"""
     loader = jinja2.FileSystemLoader(template_dir)
@@ -212,30 +394,123 @@ def generate_wellnesspage(template_dir, outputfile, alldata):
         pf.write(output)
 
 
-def generate_dailystats(logger, template_dir, outputdir, alldata):
-    """ Generate graphs for the various measurements """
+def template_digest(template_dir):
+    sha = hashlib.sha1()
+    for file_path in sorted(glob.glob(os.path.join(template_dir, '*.html'))):
+        with open(file_path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+def load_build_manifest(outputdir):
+    file_path = os.path.join(outputdir, BUILD_MANIFEST)
+    if not os.path.exists(file_path):
+        return {'template': None, 'pages': {}}
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def save_build_manifest(outputdir, manifest):
+    file_path = os.path.join(outputdir, BUILD_MANIFEST)
+    with open(file_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(file_path + '.tmp', file_path)
+
+
+def plan_build(store, outputdir, template_dir, force=False):
+    """
+    Work out which day pages need to be generated again: those of which the input files or the next day (linked
+    from the page) changed, whose page is missing, or all when the templates changed or with force.
+    Returns the dates to generate, the next day of every day with a page and the build manifest to save after.
+    """
+    days = storage.names_by_day(store)
+    dates = sorted(date for date, names in days.items() if '{}_summary.json'.format(date) in names)
+    nextdays = dict(zip(dates, dates[1:] + [None]))
+    old = load_build_manifest(outputdir)
+    manifest = {'template': template_digest(template_dir), 'pages': {}}
+    force = force or manifest['template'] != old['template']
+
+    todo = set()
+    for date in dates:
+        page = {'inputs': storage.stamps_digest(store, days[date]), 'nextday': nextdays[date]}
+        manifest['pages'][date] = page
+        if force or old['pages'].get(date) != page or not os.path.exists(os.path.join(outputdir, date + '.html')):
+            todo.add(date)
+    return todo, nextdays, manifest
+
+
+# Template and data of the process rendering pages, see init_renderer
+_renderer = {}
+
+
+def init_renderer(template_dir, inputdir):
+    """
+    Set up a (worker) process to render day pages from the Wellness files in inputdir
+    """
+    loader = jinja2.FileSystemLoader(template_dir)
+    environment = jinja2.Environment(loader=loader, trim_blocks=True, lstrip_blocks=True)
+    _renderer['template'] = environment.get_template('dailystats.html')
+    _renderer['store'] = storage.open_store(inputdir)
+    # Read from the columnar store when there is one, see run_visualisation
+    _renderer['columns'] = columnar.load(inputdir) if columnar.available() else None
+
+
+def day_context(day, datestamp, nextday):
+    """
+    Template context of the page of datestamp, from its data as returned by load_day
+    """
+    thisdate = datetime.strptime(datestamp, '%Y-%m-%d')
+    context = dict(day)
+    context['datedayofweek'] = thisdate.strftime('%A')  # Day of week, e.g., Sunday, Monday...
+    context['datestamp'] = datestamp
+    context['previousday'] = (thisdate - timedelta(days=1)).strftime('%Y-%m-%d')  # Assume there was no gap
+    context['nextday'] = nextday
+    return context
+
+
+def render_day(job):
+    """
+    Read the files of a day, render its page and write it to the output directory, atomically so a reader never
+    sees half a page
+    """
+    outputdir, datestamp, nextday = job
+    day = load_day(_renderer['store'], datestamp, _renderer['columns'])
+    output = _renderer['template'].render(day_context(day, datestamp, nextday))
+    with storage.atomic_write(os.path.join(outputdir, datestamp + '.html')) as pf:
+        pf.write(output.encode('utf-8'))
+    return datestamp
+
+
+def generate_dailystats(logger, template_dir, outputdir, inputdir, nextdays, dates=None, workers=1):
+    """
+    Generate graphs for the various measurements of the days in dates (by default all of nextdays, which maps
+    the date of every page to that of the next one). The pages are rendered in `workers` processes, that each
+    read the files of a day only when rendering it, so memory use does not grow with the number of days.
+    """
     loader = jinja2.FileSystemLoader(template_dir)
     environment = jinja2.Environment(loader=loader, trim_blocks=True, lstrip_blocks=True)
 
     try:
-        template = environment.get_template('dailystats.html')
+        environment.get_template('dailystats.html')
     except jinja2.exceptions.TemplateNotFound as e:
         logger.error('Template not found: %s in template dir %s', str(e), template_dir)
         sys.exit(2)
 
-    nextday = None
-    for datestamp, summary in alldata['summaries']:
-        outputfile = os.path.join(outputdir, datestamp + '.html')
-        thisdate = datetime.strptime(datestamp, '%Y-%m-%d')
-        alldata['datedayofweek'] = thisdate.strftime('%A')  # Day of week, e.g., Sunday, Monday...
-        alldata['datestamp'] = datestamp
-        alldata['summary'] = summary
-        alldata['previousday'] = (thisdate - timedelta(days=1)).strftime('%Y-%m-%d')  # Assume there was no gap
-        alldata['nextday'] = nextday
-        output = template.render(alldata)
-        with open(outputfile, 'w') as pf:
-            pf.write(output)
-        nextday = datestamp
+    if dates is None:
+        dates = nextdays.keys()
+    jobs = [(outputdir, datestamp, nextdays[datestamp]) for datestamp in sorted(dates, reverse=True)]
+
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers, init_renderer, (template_dir, inputdir))
+        try:
+            pool.map(render_day, jobs, max(1, len(jobs) // (workers * 4)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_renderer(template_dir, inputdir)
+        for job in jobs:
+            render_day(job)
 
 
 def run_visualisation():
@@ -248,6 +523,10 @@ def run_visualisation():
                         help='Input directory.', default=os.path.join(os.getcwd(), 'Wellness/'))
     parser.add_argument('-o', '--output', required=False,
                         help='Output directory.', default=os.path.join(os.getcwd(), 'Graphs/'))
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of processes rendering pages (default: one per core)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Generate all pages, not only those of which the data changed since the last run')
     args = vars(parser.parse_args())
 
     # Sanity check, before we do anything:
@@ -258,7 +537,6 @@ def run_visualisation():
     # Try to use the user argument from command line
     outputdir = args['output']
     inputdir = args['input']
-    alldata = parse_files(logger, inputdir, outputdir)
     template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'templates')
     #outputfile = os.path.join(outputdir, 'wellness.html')
 
@@ -266,8 +544,17 @@ def run_visualisation():
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
 
-    #generate_wellnesspage(template_dir, outputfile, alldata)
-    generate_dailystats(logger, template_dir, outputdir, alldata)
+    # Only read and generate the days that changed since the last run
+    dates, nextdays, manifest = plan_build(storage.open_store(inputdir), outputdir, template_dir, args['force'])
+    logger.info('Generating %d pages', len(dates))
+
+    # Bring those days up to date in the columnar store the pages are read from
+    if columnar.available():
+        columnar.ingest(inputdir, dates)
+
+    #generate_wellnesspage(template_dir, outputfile, parse_files(logger, inputdir, outputdir))
+    generate_dailystats(logger, template_dir, outputdir, inputdir, nextdays, dates, args['workers'])
+    save_build_manifest(outputdir, manifest)
 
 
 if __name__ == "__main__":